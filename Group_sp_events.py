@@ -19,11 +19,10 @@ from time import strftime # used to print current time
 import glob
 import os.path
 import infodata
-import matplotlib.pyplot as plt
 #from guppy import hpy # for memory usage
 #from memory_profiler import profile
-from Pgplot import *
-from scipy.special import erf
+# matplotlib, ppgplot and scipy.special are imported by the functions
+# that use them, so they are not loaded when PLOT is off.
 import optparse
 import sys
 #h = hpy()
@@ -489,6 +488,7 @@ def rank_groups(groups, min_group = MIN_GROUP):
                 pass 
 
 def ddm_response(ddm, width_ms, band_MHz=(1214., 1537.)):
+    from scipy.special import erf
     if np.isscalar(ddm):
         ddm = np.array([ddm])
         scal = True
@@ -558,6 +558,7 @@ def plot_sp_rated_all(groups, ranks, inffile, ylow=0, yhigh=100, xlow=0, xhigh=1
         colour corresponding to group rank. 
         The DM range to plot can also be specified.
     """
+    import matplotlib.pyplot as plt
    # rank_to_color = {2:'r', 0:'k', 3:'g', 4:'b', 5:'m', 6:'c', 7:'y'}
     rank_to_color = {2:'darkgrey', 0:'k', 3:'c', 4:'royalblue', 5:'b', 6:'m'}
 
@@ -612,6 +613,7 @@ def plot_sp_rated_pgplot(groups, ranks, inffile, ylow=0, yhigh=100, xlow=0, xhig
         Outputs:
             None; saves a colorized sp plot.
     """
+    import ppgplot
     if get_obs_info(inffile) is not None: # if inf files exist, can get obs info
         obsinfo = get_obs_info(inffile)
         #plt.title('Single Pulse Results for %s\nRA: %s Dec: %s' % 
@@ -5,11 +5,9 @@
    Modified to return topocentric and corresponding barycentric
    times. 
 """
-from presto.prestoswig import *
+import os
+import hashlib
 import numpy as Num
-import Pgplot
-import psr_utils
-import glob
 
 def read_inffile(filename):
    """
@@ -18,9 +16,10 @@ def read_inffile(filename):
        'inf' file in 'filename'.  'filename' should not include the
        '.inf' suffix.
    """
-   id = infodata()
+   from presto import prestoswig
+   id = prestoswig.infodata()
    print "Reading information from", "\""+filename+".inf\""
-   readinf(id, filename)
+   prestoswig.readinf(id, filename)
    return id
 
 def bary_to_topo(infofilenm, ephem="DE200"):
@@ -29,6 +28,10 @@ def bary_to_topo(infofilenm, ephem="DE200"):
       Returns the barycentric and topocentric times evert 10 seconds.
       The data for the observation must be found in the info file.
    """
+   # PRESTO is only needed when the times actually have to be computed
+   from presto import prestoswig
+   import psr_utils
+   SECPERDAY = prestoswig.SECPERDAY
    if infofilenm[-4:]==".inf":  infofilenm = infofilenm[:-4]
    obs = read_inffile(infofilenm)
    T = obs.N * obs.dt
@@ -48,8 +51,126 @@ def bary_to_topo(infofilenm, ephem="DE200"):
    else:
       print "Telescope not recognized."
       return 0
-   barycenter(tts, bts, vel, nn, ra, dec, tel, ephem)
+   prestoswig.barycenter(tts, bts, vel, nn, ra, dec, tel, ephem)
    avgvel = Num.add.reduce(vel) / nn
    tts = Num.arange(nn, dtype='d') * dt
    bts = (bts - bts[0]) * SECPERDAY
    return tts, bts
+
+def mjd_to_cal(mjd):
+   """
+   mjd_to_cal(mjd):
+      Return the calendar date (year, month, day) of the MJD 'mjd'.
+      The day is fractional. (Meeus, Astronomical Algorithms, ch. 7)
+   """
+   jd = mjd + 2400000.5
+   Z = int(jd + 0.5)
+   F = jd + 0.5 - Z
+   if Z < 2299161:
+      A = Z
+   else:
+      alpha = int((Z - 1867216.25) / 36524.25)
+      A = Z + 1 + alpha - int(alpha / 4)
+   B = A + 1524
+   C = int((B - 122.1) / 365.25)
+   D = int(365.25 * C)
+   E = int((B - D) / 30.6001)
+   day = B - D - int(30.6001 * E) + F
+   if E < 14:
+      month = E - 1
+   else:
+      month = E - 13
+   if month > 2:
+      year = C - 4716
+   else:
+      year = C - 4715
+   return year, month, day
+
+def cached_bary_to_topo(infofilenm, ephem="DE200"):
+   """
+   cached_bary_to_topo(infofilenm, ephem="DE200"):
+      Returns the topocentric and barycentric times every 10 seconds
+      (as bary_to_topo does) and the calendar date of the start of the
+      observation. The results are kept in a '.bary.npz' sidecar next
+      to the info file and are only recomputed when the contents of
+      the info file or the ephemeris change.
+   """
+   if infofilenm[-4:]==".inf":  infofilenm = infofilenm[:-4]
+   cachefn = infofilenm+".bary.npz"
+   infile = open(infofilenm+".inf", 'rb')
+   key = hashlib.md5(infile.read() + ephem).hexdigest()
+   infile.close()
+   if os.path.isfile(cachefn):
+      try:
+         cache = Num.load(cachefn)
+         try:
+            # The arrays are read from the file on access
+            if str(cache['key']) == key:
+               year, month, day = cache['date']
+               return cache['topo'], cache['bary'], (int(year), int(month), day)
+         finally:
+            cache.close()
+      except (IOError, ValueError, KeyError):
+         pass
+   result = bary_to_topo(infofilenm, ephem)
+   if not result:
+      return result
+   tts, bts = result
+   obs = read_inffile(infofilenm)
+   date = mjd_to_cal(obs.mjd_i + obs.mjd_f)
+   try:
+      tmpfn = cachefn+".tmp"
+      with open(tmpfn, 'wb') as f:
+         Num.savez(f, key=key, topo=tts, bary=bts, date=Num.array(date))
+      os.rename(tmpfn, cachefn)
+   except (IOError, OSError):
+      # Caching is only an optimisation (e.g. read-only directories)
+      pass
+   return tts, bts, date
+
+class TimeConverter(object):
+   """
+   TimeConverter(topo, bary):
+      Convert arrays of times between the topocentric and barycentric
+      frames of one observation. The conversion linearly interpolates
+      the table returned by bary_to_topo, so it only needs to be
+      built once per observation.
+   """
+   def __init__(self, topo, bary):
+      self.topo = Num.asarray(topo, dtype='d')
+      self.bary = Num.asarray(bary, dtype='d')
+      assert self.topo.shape == self.bary.shape
+
+   @classmethod
+   def from_inffile(cls, infofilenm, ephem="DE200", cache=True):
+      """
+      TimeConverter.from_inffile(infofilenm, ephem="DE200", cache=True):
+         Build a TimeConverter from the observation described by
+         the info file 'infofilenm'. If 'cache' is True the table
+         is read from (or saved to) the sidecar used by
+         cached_bary_to_topo.
+      """
+      if cache:
+         result = cached_bary_to_topo(infofilenm, ephem)
+      else:
+         result = bary_to_topo(infofilenm, ephem)
+      if not result:
+         raise ValueError("Cannot compute barycentric times for '%s'" % \
+                          infofilenm)
+      return cls(result[0], result[1])
+
+   def topo_to_bary(self, times):
+      """
+      topo_to_bary(times):
+         Return the barycentric times (s) corresponding to the
+         topocentric times (s) in 'times'.
+      """
+      return Num.interp(times, self.topo, self.bary)
+
+   def bary_to_topo(self, times):
+      """
+      bary_to_topo(times):
+         Return the topocentric times (s) corresponding to the
+         barycentric times (s) in 'times'.
+      """
+      return Num.interp(times, self.bary, self.topo)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+spectra_kernels.py
+
+Micro-benchmark of the subband and downsample kernels used by
+sp_pulsar.formats.spectra, compared with the split-and-stack
+implementations they replaced.
+
+Usage:
+    python benchmarks/spectra_kernels.py [-c NCHAN] [-n NSPEC] [--nsub NSUB] [--downsamp FACTOR]
+
+The default array size is modest. Use '-c 4096 -n 1048576 --dtype float32'
+for the full-size (16 GB) comparison.
+"""
+
+import os
+import sys
+import time
+import optparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sp_pulsar.formats import spectra
+
+
+def old_subband(data, nsub):
+    return np.array([np.sum(sub, axis=0) for sub in np.vsplit(data, nsub)])
+
+
+def old_downsample(data, factor):
+    nout = data.shape[1]//factor
+    data = data[:,:nout*factor]
+    return np.array(np.column_stack([np.sum(subint, axis=1) for \
+                        subint in np.hsplit(data, nout)]))
+
+
+def best_time(func, repeat):
+    """Return the best wall-clock time (in seconds) of 'repeat'
+        calls to 'func'.
+    """
+    times = []
+    for ii in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    data = np.random.normal(size=(options.nchan, options.nspec)).astype(options.dtype)
+    subbuf = np.empty((options.nsub, options.nspec), dtype=data.dtype)
+    dsbuf = np.empty((options.nchan, options.nspec//options.downsamp), dtype=data.dtype)
+    benchmarks = [('subband', \
+                    lambda: old_subband(data, options.nsub), \
+                    lambda: spectra._subband_sum(data, options.nsub, subbuf)), \
+                  ('downsample', \
+                    lambda: old_downsample(data, options.downsamp), \
+                    lambda: spectra._downsample_sum(data, options.downsamp, dsbuf))]
+    print "Array: %d channels x %d spectra (%s)" % \
+            (options.nchan, options.nspec, options.dtype)
+    for name, old, new in benchmarks:
+        told = best_time(old, options.repeat)
+        tnew = best_time(new, options.repeat)
+        print "%-12s old: %8.3f s  new: %8.3f s  speed-up: %6.1fx" % \
+                (name, told, tnew, told/tnew)
+
+
+if __name__=='__main__':
+    parser = optparse.OptionParser(prog="spectra_kernels.py", \
+                        usage="%prog [OPTIONS]", \
+                        description="Time the Spectra subband and " \
+                                    "downsample kernels.")
+    parser.add_option('-c', '--nchan', dest='nchan', type='int', \
+                        help="Number of channels. (Default: 4096)", \
+                        default=4096)
+    parser.add_option('-n', '--nspec', dest='nspec', type='int', \
+                        help="Number of spectra. (Default: 16384)", \
+                        default=16384)
+    parser.add_option('--nsub', dest='nsub', type='int', \
+                        help="Number of subbands. (Default: 64)", \
+                        default=64)
+    parser.add_option('--downsamp', dest='downsamp', type='int', \
+                        help="Downsampling factor. (Default: 8)", \
+                        default=8)
+    parser.add_option('--dtype', dest='dtype', type='string', \
+                        help="Data type of the array. (Default: float64)", \
+                        default='float64')
+    parser.add_option('--repeat', dest='repeat', type='int', \
+                        help="Number of timing repeats. (Default: 3)", \
+                        default=3)
+    options, args = parser.parse_args()
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+startup.py
+
+Measure the cold-start import time of the command line tools and check
+it against a time budget. Each module is imported in a fresh
+interpreter several times and the median wall-clock time is reported.
+The exit status is non-zero if any module is over budget, or if
+importing it loads one of the heavy PRESTO/plotting modules that the
+tools only need once they run.
+
+Usage:
+    python benchmarks/startup.py [--budget SECONDS] [--repeat N] [MODULE ...]
+"""
+
+import os
+import sys
+import time
+import optparse
+import subprocess
+
+MODULES = ['sp_pipeline', 'waterfaller', 'Group_sp_events', 'bary_and_topo']
+# Modules that must not be loaded just by importing the tools
+HEAVY_MODULES = ['psr_utils', 'presto', 'Pgplot', 'ppgplot', 'rfifind', \
+                 'matplotlib', 'scipy', 'astropy']
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _import_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([TOPDIR, env.get('PYTHONPATH', '')])
+    return env
+
+
+def time_import(module, repeat):
+    """Return the median time (in seconds) it takes a new
+        interpreter to import 'module'.
+
+        Inputs:
+            module: Name of the module to import.
+            repeat: Number of interpreters to start.
+
+        Output:
+            median: Median wall-clock time of the imports.
+    """
+    env = _import_env()
+    times = []
+    for ii in range(repeat):
+        start = time.time()
+        retcode = subprocess.call([sys.executable, '-c', 'import %s' % module], \
+                                  env=env)
+        times.append(time.time() - start)
+        if retcode:
+            raise RuntimeError("Importing '%s' failed!" % module)
+    times.sort()
+    return times[len(times)//2]
+
+
+def heavy_imports(module):
+    """Return the heavy modules (see HEAVY_MODULES) that are
+        loaded by importing 'module' in a new interpreter.
+    """
+    code = "import sys, %s\n" \
+           "print ' '.join(m for m in %r if m in sys.modules)" % \
+           (module, HEAVY_MODULES)
+    proc = subprocess.Popen([sys.executable, '-c', code], \
+                            stdout=subprocess.PIPE, env=_import_env())
+    output = proc.communicate()[0]
+    if proc.returncode:
+        raise RuntimeError("Importing '%s' failed!" % module)
+    return output.split()
+
+
+def main():
+    baseline = time_import('numpy', options.repeat)
+    print "%-20s %8.3f s" % ('(numpy baseline)', baseline)
+    over_budget = []
+    for module in (args or MODULES):
+        elapsed = time_import(module, options.repeat)
+        status = 'ok'
+        if elapsed > options.budget:
+            status = 'OVER BUDGET'
+            over_budget.append(module)
+        heavy = heavy_imports(module)
+        if heavy:
+            status = 'LOADS %s' % ', '.join(heavy)
+            over_budget.append(module)
+        print "%-20s %8.3f s  %s" % (module, elapsed, status)
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__=='__main__':
+    parser = optparse.OptionParser(prog="startup.py", \
+                        usage="%prog [OPTIONS] [MODULE ...]", \
+                        description="Check the import time of the " \
+                                    "single pulse tools against a budget.")
+    parser.add_option('--budget', dest='budget', type='float', \
+                        help="Maximum allowed import time per module " \
+                                "(in seconds). (Default: 0.5)", default=0.5)
+    parser.add_option('--repeat', dest='repeat', type='int', \
+                        help="Number of fresh interpreters per module. " \
+                                "(Default: 5)", default=5)
+    options, args = parser.parse_args()
+    main()
@@ -11,33 +11,177 @@ Usage on the command line:
 Chitrang Patel - May. 21, 2015
 """
 
+import os
 import sys
 import copy
+import glob
+import json
+import heapq
+import hashlib
 from time import strftime
-import infodata
-from subprocess import Popen, PIPE
 
 import numpy as np
 import math as m
 import optparse
 import waterfaller
-import sp_utils
 import bary_and_topo
-import psr_utils
-import rfifind
-import show_spplots
 
-from sp_pulsar.formats import psrfits
-from sp_pulsar.formats import spectra
+# PRESTO, rfifind, show_spplots and the PSRFITS reader are
+# imported where they are needed so that starting up stays cheap.
 
 DEBUG = True
+MIN_CAND_RANK = 3 # Groups of lower rank (noise, RFI) are never plotted
+
 def print_debug(msg):
     if DEBUG:
         print msg
 
-def topo_timeshift(bary_start_time, time_shift, topo):
-    ind = np.where(topo == float(int(bary_start_time)/10*10))[0]
-    return time_shift[ind]
+def read_group_summaries(groupsfile):
+    """
+    Iterate over the groups in a groups.txt file produced by Group_sp_events.py.
+    Only the summary of each group is parsed; its single pulse events are skipped.
+    Inputs:
+        groupsfile: name of the groups.txt file.
+    Output:
+        Yields a (rank, max sigma, number of single pulses, file offset) tuple
+        for each group. The offset points to the group's list of events.
+    """
+    f = open(groupsfile, 'r')
+    try:
+        line = f.readline()
+        while line:
+            if line.startswith("Group of"):
+                npulses = int(line.split()[2])
+                summary = {}
+                for ii in range(6):
+                    key, val = f.readline().split(':', 1)
+                    summary[key.strip()] = float(val)
+                yield int(round(summary['Rank'])), summary['Max sigma'], npulses, f.tell()
+            line = f.readline()
+    finally:
+        f.close()
+
+def select_candidates(groupsfile, maxnumcands, min_rank=MIN_CAND_RANK):
+    """
+    Pick the best groups by (rank, max sigma) with a bounded heap, streaming
+    through the groups.txt file.
+    Inputs:
+        groupsfile: name of the groups.txt file.
+        maxnumcands: maximum number of candidates to return.
+        min_rank: only groups with at least this rank are considered.
+    Output:
+        cands: list of (rank, max sigma, number of single pulses, file offset) 
+            tuples, best candidate first. Ties keep the order of the file.
+    """
+    heap = []
+    if maxnumcands <= 0:
+        return heap
+    for ii, (rank, sigma, npulses, offset) in enumerate(read_group_summaries(groupsfile)):
+        if rank < min_rank:
+            continue
+        item = (rank, sigma, -ii, npulses, offset)
+        if len(heap) < maxnumcands:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    heap.sort(reverse=True)
+    return [(rank, sigma, npulses, offset) for rank, sigma, ii, npulses, offset in heap]
+
+def read_group_events(groupsfile, offset, npulses):
+    """
+    Read the single pulse events of one group in a groups.txt file.
+    Inputs:
+        groupsfile: name of the groups.txt file.
+        offset: file offset of the group's events (from read_group_summaries).
+        npulses: number of single pulses in the group.
+    Output:
+        events: 2D array with one row (DM, sigma, time, sample, downfact) per event.
+    """
+    events = []
+    f = open(groupsfile, 'r')
+    try:
+        f.seek(offset)
+        while len(events) < npulses:
+            line = f.readline()
+            if not line:
+                break
+            if (not line.strip()) or line.startswith('#'):
+                continue
+            events.append(line.split())
+    finally:
+        f.close()
+    return np.array(events, dtype=np.float64).reshape(-1, 5)
+
+def file_md5(filename):
+    """
+    Return the md5 hex digest of the contents of a file.
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def load_manifest(manifestfn):
+    """
+    Read the manifest of a beam written by save_manifest.
+    Inputs:
+        manifestfn: name of the manifest file.
+    Output:
+        manifest: dict of candidate entries keyed by the candidate's
+            output base name. Empty if there is no (readable) manifest.
+    """
+    if not os.path.isfile(manifestfn):
+        return {}
+    try:
+        with open(manifestfn, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        print_debug("Ignoring unreadable manifest %s" % manifestfn)
+        return {}
+
+def save_manifest(manifest, manifestfn):
+    """
+    Atomically write the manifest of a beam, so a crash never leaves
+    a half-written manifest behind.
+    """
+    tmpfn = manifestfn+".tmp"
+    with open(tmpfn, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmpfn, manifestfn)
+
+def candidate_plot_files(temp_filename):
+    """
+    Return the names of the plot files that show_spplots.plot writes for a
+    candidate. The plot is named after the candidate's .spd file.
+    Inputs:
+        temp_filename: output base name of the candidate (without .spd).
+    Output:
+        plots: list of plot file names.
+    """
+    return [temp_filename+".ps"]
+
+def candidate_is_done(entry):
+    """
+    Return True if the manifest entry of a candidate is finished and its
+    .spd file and plots are still on disk with the recorded content.
+    An entry without any plots is never finished.
+    """
+    if entry.get('status') != 'done':
+        return False
+    if not entry.get('plots'):
+        return False
+    if not os.path.isfile(entry['spd']) or file_md5(entry['spd']) != entry['md5']:
+        return False
+    return all(os.path.isfile(fn) for fn in entry['plots'])
+
+def remove_candidate_outputs(entry):
+    """
+    Delete the (possibly half-written) output files of a candidate.
+    """
+    for fn in [entry['spd'], entry['spd']+".part"] + entry.get('plots', []):
+        if os.path.isfile(fn):
+            os.remove(fn)
 
 def maskdata(data, start_bin, nbinsextra, maskfile):
     """
@@ -51,6 +195,7 @@ def maskdata(data, start_bin, nbinsextra, maskfile):
     """
    
     if maskfile is not None:
+        import rfifind
         print 'masking'
         rfimask = rfifind.rfifind(maskfile)
         mask = waterfaller.get_mask(rfimask, start_bin, nbinsextra)
@@ -82,7 +227,7 @@ def waterfall_array(start_bin, dmfac, duration, nbins, zerodm, nsub, subdm, dm,
 def main():
     parser = optparse.OptionParser(prog="sp_pipeline..py", \
                         version=" Chitrang Patel (May. 12, 2015)", \
-                        usage="%prog INFILE(PsrFits FILE, SINGLEPULSE FILES)", \
+                        usage="%prog INFILE(PsrFits FILES or filterbank FILE, SINGLEPULSE FILES)", \
                         description="Create single pulse plots to show the " \
                                     "frequency sweeps of a single pulse,  " \
                                     "DM vs time, and SNR vs DM,"\
@@ -97,157 +242,228 @@ def main():
     parser.add_option('-n', dest='maxnumcands', type='int', \
                         help="Maximum number of candidates to plot. (Default: 100).", \
                         default=100)
+    parser.add_option('--cache-size', dest='cache_size', type='float', \
+                        help="Size (in MB) of the cache of decoded subints " \
+                                "shared by all candidates. (Default: 256)", \
+                        default=256)
+    parser.add_option('--threads', dest='threads', type='int', \
+                        help="Number of threads to process the data " \
+                                "with. (Default: $SP_NUM_THREADS, or 1)", \
+                        default=None)
+    parser.add_option('--force', dest='force', action='store_true', \
+                        help="Rebuild all candidates, even those the manifest " \
+                                "lists as finished. (Default: resume)", \
+                        default=False)
     options, args = parser.parse_args()
+    import infodata
+    import psr_utils
+    import show_spplots
+    from sp_pulsar.formats import psrfits
+    from sp_pulsar.formats import filterbank
+    from sp_pulsar.formats import spectra
+    if options.threads is not None:
+        spectra.set_num_threads(options.threads)
+
     if not hasattr(options, 'infile'):
         raise ValueError("A .inf file must be given on the command line! ") 
     if not hasattr(options, 'txtfile'):
         raise ValueError("The groups.txt file must be given on the command line! ") 
     
-    files = sp_utils.spio.get_textfile(options.txtfile)
     print_debug("Begining waterfaller... "+strftime("%Y-%m-%d %H:%M:%S"))
-    if not args[0].endswith("fits"):
-        raise ValueError("The first file must be a psrFits file! ") 
+    if args[0].endswith(".fil"):
+        filetype = "filterbank"
+        basename = args[0][:-4]
+        spfiles = args[1:]
+    elif args[0].endswith("fits"):
+        filetype = "psrfits"
+        basename = args[0][:-5]
+        # All leading psrFits files are read as one continuous observation
+        nfits = 1
+        while (nfits < len(args)) and args[nfits].endswith("fits"):
+            nfits += 1
+        fitsfiles = args[:nfits]
+        spfiles = args[nfits:]
+    else:
+        raise ValueError("The first file must be a psrFits or filterbank file! ") 
     print_debug('Maximum number of candidates to plot: %i'%options.maxnumcands)
-    basename = args[0][:-5]
-    filetype = "psrfits"
     inffile = options.infile
-    topo, bary = bary_and_topo.bary_to_topo(inffile)
-    time_shift = bary-topo
+    obstimes = bary_and_topo.cached_bary_to_topo(inffile)
+    if not obstimes:
+        raise ValueError("Cannot compute barycentric times for %s" % inffile)
+    topo, bary, date = obstimes
+    timeconv = bary_and_topo.TimeConverter(topo, bary)
     inf = infodata.infodata(inffile)
     RA = inf.RA
     dec = inf.DEC
     MJD = inf.epoch
-    mjd = Popen(["mjd2cal", "%f"%MJD], stdout=PIPE, stderr=PIPE)
-    date, err = mjd.communicate()
-    date = date.split()[2:5]
     telescope = inf.telescope
     N = inf.N
     Total_observed_time = inf.dt *N
     print_debug('getting file..')
-    rawdatafile = psrfits.PsrfitsFile(args[0])
-    bin_shift = np.round(time_shift/rawdatafile.tsamp).astype('int')
-    numcands = 0 # candidate counter. Use this to decide the maximum bumber of candidates to plot.
-    loop_must_break = False # dont break the loop unless num of cands >100.
-    for group in [6, 5, 4, 3, 2]:
-        rank = group+1
-        if files[group] != "Number of rank %i groups: 0 "%rank:
-            print_debug(files[group])
-            values = sp_utils.spio.split_parameters(rank, options.txtfile)
-            lis = np.where(files == '\tRank:             %i.000000'%rank)[0]
-            for ii in range(len(values)):
-                #### Array for Plotting DM vs SNR
-                print_debug("Making arrays for DM vs Signal to Noise...")
-                temp_list = files[lis[ii]-6].split()
-                npulses = int(temp_list[2])
-                temp_lines = files[(lis[ii]+3):(lis[ii]+npulses+1)]
-                arr = np.split(temp_lines, len(temp_lines))
-                dm_list = []
-                time_list = []
-                for i in range(len(arr)):
-                    dm_val= float(arr[i][0].split()[0])
-                    time_val = float(arr[i][0].split()[2])
-                    dm_list.append(dm_val)
-                    time_list.append(time_val)
-                arr_2 = np.array([arr[i][0].split() for i in range(len(arr))], dtype = np.float32)
-                dm_arr = np.array([arr_2[i][0] for i in range(len(arr))], dtype = np.float32)
-                sigma_arr = np.array([arr_2[i][1] for i in range(len(arr))], dtype = np.float32)
-
-                #### Array for Plotting DM vs Time is in show_spplots.plot(...)
-
-                
-                #### Setting variables up for the waterfall arrays.
-                j = ii+1
-                subdm = dm = sweep_dm= values[ii][0]
-                integrate_dm = None
-                sigma = values[ii][1]
-                sweep_posn = 0.0
-                bary_start_time = values[ii][2]
-                topo_start_time = bary_start_time - topo_timeshift(bary_start_time, time_shift, topo)[0]
-                sample_number = values[ii][3]
-                width_bins = values[ii][4]
-                binratio = 50
-                scaleindep = False
-                zerodm = None
-                downsamp = np.round((values[ii][2]/sample_number/rawdatafile.tsamp)).astype('int')
-                duration = binratio * width_bins * rawdatafile.tsamp * downsamp
-                start = topo_start_time - (0.25 * duration)
-                if (start<0.0):
-                    start = 0.0
-                pulse_width = width_bins*downsamp*rawdatafile.tsamp
-                if sigma < 10:
-                    nsub = 32
-                elif sigma >= 10 and sigma < 15:
-                    nsub = 64
-                else:
-                    nsub = 96
-                
-                if nsub > inf.numchan:
-                    nsub = inf.numchan
-
-                nbins = np.round(duration/rawdatafile.tsamp).astype('int')
-                start_bin = np.round(start/rawdatafile.tsamp).astype('int')
-                dmfac = 4.15e3 * np.abs(1./rawdatafile.frequencies[0]**2 - 1./rawdatafile.frequencies[-1]**2)
-                nbinsextra = np.round((duration + dmfac * dm)/rawdatafile.tsamp).astype('int')
-                if (start_bin+nbinsextra) > N-1:
-                    nbinsextra = N-1-start_bin
-                data = rawdatafile.get_spectra(start_bin, nbinsextra)
-                data = maskdata(data, start_bin, nbinsextra, options.maskfile)
-
-                #make an array to store header information for the .npz files
-                temp_filename = basename+"_DM%.1f_%.1fs_rank_%i"%(subdm, topo_start_time, rank)
-                # Array for Plotting Dedispersed waterfall plot - zerodm - OFF
-                print_debug("Running waterfaller with Zero-DM OFF...")
-                data, Data_dedisp_nozerodm = waterfall_array(start_bin, dmfac, duration, nbins, zerodm, nsub, subdm, dm, integrate_dm, downsamp, scaleindep, width_bins, rawdatafile, binratio, data)
-                # Add additional information to the header information array
-                text_array = np.array([args[0], 'Arecibo', RA, dec, MJD, rank, nsub, nbins, subdm, sigma, sample_number, duration, width_bins, pulse_width, rawdatafile.tsamp, Total_observed_time, topo_start_time, data.starttime, data.dt, data.numspectra, data.freqs.min(), data.freqs.max()])
-
-                #### Array for plotting Dedispersed waterfall plot zerodm - ON
-                print_debug("Running Waterfaller with Zero-DM ON...")
-                data = rawdatafile.get_spectra(start_bin, nbinsextra)
-                data = maskdata(data, start_bin, nbinsextra, options.maskfile)
-                zerodm = True
-                data, Data_dedisp_zerodm = waterfall_array(start_bin, dmfac, duration, nbins, zerodm, nsub, subdm, dm, integrate_dm, downsamp, scaleindep, width_bins, rawdatafile, binratio, data)
-                ####Sweeped without zerodm
-                start = start + (0.25*duration)
-                start_bin = np.round(start/rawdatafile.tsamp).astype('int')
-                sweep_duration = 4.15e3 * np.abs(1./rawdatafile.frequencies[0]**2-1./rawdatafile.frequencies[-1]**2)*sweep_dm
-                nbins = np.round(sweep_duration/(rawdatafile.tsamp)).astype('int')
-                if ((nbins+start_bin)> (N-1)):
-                    nbins = N-1-start_bin
-                data = rawdatafile.get_spectra(start_bin, nbins)
-                data = maskdata(data, start_bin, nbins, options.maskfile)
-                zerodm = None
-                dm = None
-                data, Data_nozerodm = waterfall_array(start_bin, dmfac, duration, nbins, zerodm, nsub, subdm, dm, integrate_dm, downsamp, scaleindep, width_bins, rawdatafile, binratio, data)
-                text_array = np.append(text_array, sweep_duration)
-                text_array = np.append(text_array, data.starttime)
-                text_array = np.append(text_array, bary_start_time)
-                # Array to Construct the sweep
-                if sweep_dm is not None:
-                    ddm = sweep_dm-data.dm
-                    delays = psr_utils.delay_from_DM(ddm, data.freqs)
-                    delays -= delays.min()
-                    delays_nozerodm = delays
-                    freqs_nozerodm = data.freqs
-                # Sweeped with zerodm-on 
-                zerodm = True
-                downsamp_temp = 1
-                data, Data_zerodm = waterfall_array(start_bin, dmfac, duration, nbins, zerodm, nsub, subdm, dm, integrate_dm, downsamp_temp, scaleindep, width_bins, rawdatafile, binratio, data)
-                # Saving the arrays into the .spd file.
-                with open(temp_filename+".spd", 'wb') as f:
-                    np.savez_compressed(f, Data_dedisp_nozerodm = Data_dedisp_nozerodm.astype(np.float16), Data_dedisp_zerodm = Data_dedisp_zerodm.astype(np.float16), Data_nozerodm = Data_nozerodm.astype(np.float16), delays_nozerodm = delays_nozerodm, freqs_nozerodm = freqs_nozerodm, Data_zerodm = Data_zerodm.astype(np.float16), dm_arr= map(np.float16, dm_arr), sigma_arr = map(np.float16, sigma_arr), dm_list= map(np.float16, dm_list), time_list = map(np.float16, time_list), text_array = text_array)
-                print_debug("Now plotting...")
-                show_spplots.plot(temp_filename+".spd", args[1:], xwin=False, outfile = basename, tar = None)
-                print_debug("Finished plot %i " %j+strftime("%Y-%m-%d %H:%M:%S"))
-                numcands+= 1
-                print_debug('Finished sp_candidate : %i'%numcands)
-                if numcands >= options.maxnumcands:    # Max number of candidates to plot 100.
-                    loop_must_break = True
-                    break
-            if loop_must_break:
-                break
-        print_debug("Finished group %i... "%rank+strftime("%Y-%m-%d %H:%M:%S"))
+    if filetype == "filterbank":
+        rawdatafile = filterbank.FilterbankFile(args[0])
+    else:
+        rawdatafile = psrfits.PsrfitsFile(fitsfiles, cache_size=options.cache_size, \
+                                            header_cache=True)
+    # Dispersion delay tables are shared by all candidates
+    dmfac = spectra.DelayTable.get(rawdatafile.frequencies, rawdatafile.tsamp).dmfac
+    # The manifest records finished candidates so an interrupted run can resume
+    manifestfn = basename+"_sp_manifest.json"
+    manifest = load_manifest(manifestfn)
+    if options.force:
+        for entry in manifest.values():
+            remove_candidate_outputs(entry)
+        manifest = {}
+    print_debug("Selecting the best %i candidates... "%options.maxnumcands+strftime("%Y-%m-%d %H:%M:%S"))
+    cands = select_candidates(options.txtfile, options.maxnumcands)
+    # Only the selected groups have their single pulse events parsed
+    events = [read_group_events(options.txtfile, offset, npulses) \
+                for rank, sigma, npulses, offset in cands]
+    # Each candidate is described by the brightest event of its group
+    values = np.array([ev[np.argmax(ev[:,1])] for ev in events]).reshape(-1, 5)
+    # Convert the start times of all candidates and the times of their
+    # group events to topocentric times in one call
+    alltimes = np.concatenate([values[:,2]] + [ev[:,2] for ev in events])
+    topo_times = timeconv.bary_to_topo(alltimes)
+    topo_start_times = topo_times[:len(cands)]
+    groupsizes = [len(ev) for ev in events]
+    topo_event_times = np.split(topo_times[len(cands):], np.cumsum(groupsizes)[:-1])
+    for ii in range(len(cands)):
+        rank = cands[ii][0]
+        #### Array for Plotting DM vs SNR
+        print_debug("Making arrays for DM vs Signal to Noise...")
+        dm_list = events[ii][:,0].tolist()
+        # Topocentric, like the start time of the waterfall plots
+        time_list = topo_event_times[ii].tolist()
+        dm_arr = events[ii][:,0].astype(np.float32)
+        sigma_arr = events[ii][:,1].astype(np.float32)
+
+        #### Array for Plotting DM vs Time is in show_spplots.plot(...)
+
+        
+        #### Setting variables up for the waterfall arrays.
+        j = ii+1
+        subdm = dm = sweep_dm= values[ii][0]
+        integrate_dm = None
+        sigma = values[ii][1]
+        sweep_posn = 0.0
+        bary_start_time = values[ii][2]
+        topo_start_time = topo_start_times[ii]
+        sample_number = int(values[ii][3])
+        width_bins = int(values[ii][4])
+        binratio = 50
+        scaleindep = False
+        zerodm = None
+        downsamp = np.round((values[ii][2]/sample_number/rawdatafile.tsamp)).astype('int')
+        duration = binratio * width_bins * rawdatafile.tsamp * downsamp
+        start = topo_start_time - (0.25 * duration)
+        if (start<0.0):
+            start = 0.0
+        pulse_width = width_bins*downsamp*rawdatafile.tsamp
+        if sigma < 10:
+            nsub = 32
+        elif sigma >= 10 and sigma < 15:
+            nsub = 64
+        else:
+            nsub = 96
+        
+        if nsub > inf.numchan:
+            nsub = inf.numchan
+
+        temp_filename = basename+"_DM%.1f_%.1fs_rank_%i"%(subdm, topo_start_time, rank)
+        entry = manifest.get(temp_filename)
+        if entry is not None:
+            if candidate_is_done(entry):
+                print_debug("Skipping finished candidate %s" % temp_filename)
+                continue
+            # Left over from an interrupted run
+            remove_candidate_outputs(entry)
+        entry = {'status': 'started', \
+                 'params': {'rank': int(rank), 'dm': float(dm), 'sigma': float(sigma), \
+                            'bary_start_time': float(bary_start_time), \
+                            'topo_start_time': float(topo_start_time), \
+                            'sample_number': sample_number, 'width_bins': width_bins, \
+                            'downsamp': int(downsamp), 'nsub': int(nsub)}, \
+                 'spd': temp_filename+".spd", \
+                 'plots': candidate_plot_files(temp_filename), 'md5': None}
+        # The expected plots are recorded before anything is written, so
+        # the outputs of an interrupted run can always be cleaned up
+        manifest[temp_filename] = entry
+        save_manifest(manifest, manifestfn)
+
+        nbins = np.round(duration/rawdatafile.tsamp).astype('int')
+        start_bin = np.round(start/rawdatafile.tsamp).astype('int')
+        nbinsextra = np.round((duration + dmfac * dm)/rawdatafile.tsamp).astype('int')
+        if (start_bin+nbinsextra) > N-1:
+            nbinsextra = N-1-start_bin
+        # The data are read and masked once; the operations are only run
+        # when each waterfall array is made, and the zero-DM OFF and ON
+        # variants share the masked data.
+        # The raw data are not used again, so masking can reuse their buffer
+        maskeddata = maskdata(spectra.LazySpectra(rawdatafile.get_spectra(start_bin, nbinsextra), consume=True), \
+                              start_bin, nbinsextra, options.maskfile)
+
+        #make an array to store header information for the .npz files
+        # Array for Plotting Dedispersed waterfall plot - zerodm - OFF
+        print_debug("Running waterfaller with Zero-DM OFF...")
+        data, Data_dedisp_nozerodm = waterfall_array(start_bin, dmfac, duration, nbins, zerodm, nsub, subdm, dm, integrate_dm, downsamp, scaleindep, width_bins, rawdatafile, binratio, maskeddata)
+        # Add additional information to the header information array
+        text_array = np.array([args[0], 'Arecibo', RA, dec, MJD, rank, nsub, nbins, subdm, sigma, sample_number, duration, width_bins, pulse_width, rawdatafile.tsamp, Total_observed_time, topo_start_time, data.starttime, data.dt, data.numspectra, data.freqs.min(), data.freqs.max()])
+
+        #### Array for plotting Dedispersed waterfall plot zerodm - ON
+        print_debug("Running Waterfaller with Zero-DM ON...")
+        zerodm = True
+        data, Data_dedisp_zerodm = waterfall_array(start_bin, dmfac, duration, nbins, zerodm, nsub, subdm, dm, integrate_dm, downsamp, scaleindep, width_bins, rawdatafile, binratio, maskeddata)
+        ####Sweeped without zerodm
+        start = start + (0.25*duration)
+        start_bin = np.round(start/rawdatafile.tsamp).astype('int')
+        sweep_duration = dmfac*sweep_dm
+        nbins = np.round(sweep_duration/(rawdatafile.tsamp)).astype('int')
+        if ((nbins+start_bin)> (N-1)):
+            nbins = N-1-start_bin
+        data = spectra.LazySpectra(rawdatafile.get_spectra(start_bin, nbins), consume=True)
+        data = maskdata(data, start_bin, nbins, options.maskfile)
+        zerodm = None
+        dm = None
+        data, Data_nozerodm = waterfall_array(start_bin, dmfac, duration, nbins, zerodm, nsub, subdm, dm, integrate_dm, downsamp, scaleindep, width_bins, rawdatafile, binratio, data)
+        text_array = np.append(text_array, sweep_duration)
+        text_array = np.append(text_array, data.starttime)
+        text_array = np.append(text_array, bary_start_time)
+        # Array to Construct the sweep
+        if sweep_dm is not None:
+            ddm = sweep_dm-data.dm
+            delays = psr_utils.delay_from_DM(ddm, data.freqs)
+            delays -= delays.min()
+            delays_nozerodm = delays
+            freqs_nozerodm = data.freqs
+        # Sweeped with zerodm-on 
+        zerodm = True
+        downsamp_temp = 1
+        data, Data_zerodm = waterfall_array(start_bin, dmfac, duration, nbins, zerodm, nsub, subdm, dm, integrate_dm, downsamp_temp, scaleindep, width_bins, rawdatafile, binratio, data)
+        # Saving the arrays into the .spd file. Write to a temporary file first
+        # so an interrupted run never leaves a truncated .spd behind.
+        with open(temp_filename+".spd.part", 'wb') as f:
+            np.savez_compressed(f, Data_dedisp_nozerodm = Data_dedisp_nozerodm.astype(np.float16), Data_dedisp_zerodm = Data_dedisp_zerodm.astype(np.float16), Data_nozerodm = Data_nozerodm.astype(np.float16), delays_nozerodm = delays_nozerodm, freqs_nozerodm = freqs_nozerodm, Data_zerodm = Data_zerodm.astype(np.float16), dm_arr= map(np.float16, dm_arr), sigma_arr = map(np.float16, sigma_arr), dm_list= map(np.float16, dm_list), time_list = map(np.float16, time_list), text_array = text_array)
+        os.rename(temp_filename+".spd.part", temp_filename+".spd")
+        print_debug("Now plotting...")
+        show_spplots.plot(temp_filename+".spd", spfiles, xwin=False, outfile = basename, tar = None)
+        # Also record any other files the plotter wrote for this candidate
+        entry['plots'] += [fn for fn in glob.glob(temp_filename+"*") \
+                            if fn not in [entry['spd'], entry['spd']+".part"] + entry['plots']]
+        missing = [fn for fn in entry['plots'] if not os.path.isfile(fn)]
+        entry['md5'] = file_md5(entry['spd'])
+        if missing:
+            # Left as started, so the candidate is redone next time
+            print_debug("Expected plot(s) not written: %s" % ", ".join(missing))
+        else:
+            entry['status'] = 'done'
+        save_manifest(manifest, manifestfn)
+        print_debug("Finished plot %i " %j+strftime("%Y-%m-%d %H:%M:%S"))
+        print_debug('Finished sp_candidate : %i'%j)
     print_debug("Finished running waterfaller... "+strftime("%Y-%m-%d %H:%M:%S"))
+    if filetype == "psrfits":
+        print_debug("Subint cache: %d hits, %d misses" % \
+                    (rawdatafile.cache_hits, rawdatafile.cache_misses))
 
 
 if __name__=='__main__':
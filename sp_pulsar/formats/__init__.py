@@ -1 +1 @@
-__all__ = ["psrfits"]
+__all__ = ["psrfits", "filterbank", "unpacking"]
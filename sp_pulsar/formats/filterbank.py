@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""
+Read SIGPROC filterbank data.
+
+The data are memory-mapped, so reading a block of spectra only
+touches the part of the file that is requested.
+"""
+import os
+import os.path
+import struct
+
+import numpy as np
+from sp_pulsar.formats import spectra
+from sp_pulsar.formats import unpacking
+
+# Types of the SIGPROC header keywords
+header_params = {
+    "telescope_id": 'i',
+    "machine_id": 'i',
+    "data_type": 'i',
+    "barycentric": 'i',
+    "pulsarcentric": 'i',
+    "nbits": 'i',
+    "nsamples": 'i',
+    "nchans": 'i',
+    "nifs": 'i',
+    "nbeams": 'i',
+    "ibeam": 'i',
+    "tstart": 'd',
+    "tsamp": 'd',
+    "fch1": 'd',
+    "foff": 'd',
+    "fchannel": 'd',
+    "refdm": 'd',
+    "period": 'd',
+    "az_start": 'd',
+    "za_start": 'd',
+    "src_raj": 'd',
+    "src_dej": 'd',
+    "gal_l": 'd',
+    "gal_b": 'd',
+    "header_tol": 'd',
+    "signed": 'b',
+    "source_name": 'str',
+    "rawdatafile": 'str',
+    "FREQUENCY_START": 'flag',
+    "FREQUENCY_END": 'flag',
+    "HEADER_START": 'flag',
+    "HEADER_END": 'flag',
+}
+
+
+def _read_string(filfile):
+    """Read a length-prefixed string from a SIGPROC header.
+    """
+    nchar = struct.unpack('i', filfile.read(4))[0]
+    if not (0 < nchar < 80):
+        raise ValueError("Bad string length (%d) in filterbank " \
+                            "header!" % nchar)
+    return filfile.read(nchar)
+
+
+def read_header(filename):
+    """Read the header of a SIGPROC filterbank file.
+
+        Input:
+            filename: Name of the filterbank file.
+
+        Outputs:
+            header: Dictionary of header keywords and their values.
+                Channel frequencies given between FREQUENCY_START
+                and FREQUENCY_END are collected in a list under
+                'fchannel'.
+            header_size: Size of the header in bytes.
+    """
+    filfile = open(filename, 'rb')
+    try:
+        if _read_string(filfile) != "HEADER_START":
+            raise ValueError("File is not in SIGPROC filterbank " \
+                                "format!\n\t(%s)" % filename)
+        header = {}
+        while True:
+            key = _read_string(filfile)
+            if key == "HEADER_END":
+                break
+            if key not in header_params:
+                raise ValueError("Unknown filterbank header keyword " \
+                                    "(%s)!" % key)
+            ptype = header_params[key]
+            if ptype == 'flag':
+                continue
+            elif ptype == 'str':
+                value = _read_string(filfile)
+            else:
+                size = struct.calcsize(ptype)
+                value = struct.unpack(ptype, filfile.read(size))[0]
+            if key == "fchannel":
+                header.setdefault(key, []).append(value)
+            else:
+                header[key] = value
+        header_size = filfile.tell()
+    finally:
+        filfile.close()
+    return header, header_size
+
+
+class FilterbankFile(object):
+    def __init__(self, filfn):
+        """FilterbankFile constructor.
+
+            Input:
+                filfn: Name of the SIGPROC filterbank file.
+
+            Output:
+                filterbank_file: FilterbankFile object.
+
+            *** Only the first IF of files with more than one
+                (nifs > 1) is read ***
+        """
+        if not os.path.isfile(filfn):
+            raise ValueError("ERROR: File does not exist!\n\t(%s)" % filfn)
+        self.filename = filfn
+        self.filenames = [filfn]
+        self.header, self.header_size = read_header(filfn)
+        self.nbits = self.header['nbits']
+        self.nchan = self.header['nchans']
+        self.nifs = self.header.get('nifs', 1)
+        self.tsamp = self.header['tsamp']
+        if 'fchannel' in self.header:
+            self.freqs = np.array(self.header['fchannel'])
+        else:
+            self.freqs = self.header['fch1'] + \
+                            self.header['foff']*np.arange(self.nchan)
+        self.frequencies = self.freqs # Alias
+
+        # Bytes per spectrum (all IFs)
+        if self.nbits < 8:
+            self.bytes_per_spectrum = self.nifs*self.nchan*self.nbits//8
+            dtype = 'uint8'
+        elif self.nbits == 8:
+            self.bytes_per_spectrum = self.nifs*self.nchan
+            dtype = 'int8' if self.header.get('signed', 0) else 'uint8'
+        elif self.nbits == 16:
+            self.bytes_per_spectrum = self.nifs*self.nchan*2
+            dtype = 'uint16'
+        elif self.nbits == 32:
+            self.bytes_per_spectrum = self.nifs*self.nchan*4
+            dtype = 'float32'
+        else:
+            raise ValueError("Cannot read %d-bit filterbank data!" % \
+                                self.nbits)
+        datasize = os.path.getsize(filfn) - self.header_size
+        self.nsamp = int(datasize//self.bytes_per_spectrum)
+        # One row per spectrum. Rows are packed bytes if nbits < 8.
+        if self.nbits < 8:
+            rowlen = self.bytes_per_spectrum
+        else:
+            rowlen = self.nifs*self.nchan
+        self.data = np.memmap(filfn, dtype=dtype, mode='r', \
+                                offset=self.header_size, \
+                                shape=(self.nsamp, rowlen))
+
+    def get_spectra(self, startsamp, N, dtype='float32', out=None):
+        """Return 2D array of data from filterbank file.
+
+            Inputs:
+                startsamp, Starting sample
+                N: number of samples to read
+                dtype: Data type of the returned spectra.
+                    (Default: float32)
+                out: Optional preallocated (nchan, N) array to read
+                    the data into. Its type overrides 'dtype'.
+                    (Default: allocate a new array)
+
+            Output:
+                data: 2D numpy array
+        """
+        if (startsamp < 0) or (startsamp+N > self.nsamp):
+            raise ValueError("Cannot read samples %d to %d " \
+                             "(file has %d samples)" % \
+                             (startsamp, startsamp+N, self.nsamp))
+        # A view of the memory-mapped file; nothing is read yet
+        data = self.data[startsamp:startsamp+N]
+        if self.nbits < 8:
+            # SIGPROC packs the first sample into the low bits
+            data = unpacking.unpack(data, self.nbits, msb_first=False)
+        data = data[:,:self.nchan]
+        freqs = self.freqs
+        if freqs[0] < freqs[-1]:
+            # spectra module expects high frequency first.
+            data = data[:,::-1]
+            freqs = freqs[::-1]
+
+        if out is None:
+            spectra_data = np.empty((self.nchan, N), dtype=dtype)
+        else:
+            assert out.shape == (self.nchan, N)
+            spectra_data = out
+            dtype = out.dtype
+        spectra_data[:] = data.T
+        return spectra.Spectra(freqs, self.tsamp, spectra_data, \
+                               starttime=self.tsamp*startsamp, dm=0, \
+                               dtype=dtype)
@@ -15,13 +15,14 @@ import os.path
 import warnings
 import sys
 import argparse
+import cPickle
+from collections import OrderedDict
 
-import pyslalib.slalib as slalib
 import astropy.io.fits as pyfits
 import numpy as np
 import psr_utils
-import astro_utils.protractor as protractor
 from sp_pulsar.formats import spectra
+from sp_pulsar.formats import unpacking
 
 # Regular expression for parsing DATE-OBS card's format.
 date_obs_re = re.compile(r"^(?P<year>[0-9]{4})-(?P<month>[0-9]{2})-" \
@@ -34,6 +35,8 @@ debug = True
 
 def unpack_4bit(data):                       
     """Unpack 4-bit data that has been read in as bytes.
+        The first sample of each byte is in the most significant
+        bits, following the PSRFITS convention.
 
         Input: 
             data4bit: array of unsigned 4-bit ints packed into
@@ -43,30 +46,204 @@ def unpack_4bit(data):
             outdata: unpacked array. The size of this array will 
                 be twice the size of the input data.
     """
-    first_piece = np.bitwise_and(15,data)
-    second_piece = data >> 4
-    return np.dstack([first_piece,second_piece]).flatten()
+    return unpacking.unpack(np.ravel(data), 4)
 
 
 class PsrfitsFile(object):
-    def __init__(self, psrfitsfn):
-        if not os.path.isfile(psrfitsfn):
-            raise ValueError("ERROR: File does not exist!\n\t(%s)" % \
-                                psrfitsfn)
-        self.filename = psrfitsfn
-        self.fits = pyfits.open(psrfitsfn, mode='readonly', memmap=True)
-        self.specinfo = SpectraInfo([psrfitsfn]) 
+    def __init__(self, psrfitsfns, cache_size=0, header_cache=False):
+        """PsrfitsFile constructor.
+
+            Inputs:
+                psrfitsfns: Name of the PSRFITS file, or a list of
+                    the names of the files of an observation. The
+                    files are presented as one continuous stream
+                    of samples, with any gaps between files padded.
+                cache_size: Size (in MB) of the cache of decoded
+                    subints used by get_spectra. (Default: no cache)
+                header_cache: If True, keep the parsed header
+                    information in a sidecar file (see SpectraInfo)
+                    so that re-opening the files is fast.
+                    (Default: False)
+
+            Output:
+                psrfits_file: PsrfitsFile object.
+        """
+        if isinstance(psrfitsfns, basestring):
+            psrfitsfns = [psrfitsfns]
+        for fn in psrfitsfns:
+            if not os.path.isfile(fn):
+                raise ValueError("ERROR: File does not exist!\n\t(%s)" % \
+                                    fn)
+        self.filenames = psrfitsfns
+        self.filename = psrfitsfns[0]
+        self.fitslist = [pyfits.open(fn, mode='readonly', memmap=True) \
+                            for fn in psrfitsfns]
+        self.fits = self.fitslist[0]
+        self.specinfo = SpectraInfo(psrfitsfns, hdus=self.fitslist, \
+                                    cache=header_cache)
         self.header = self.fits[0].header # Primary HDU
         self.nbits = self.specinfo.bits_per_sample
         self.nchan = self.specinfo.num_channels
         self.nsamp_per_subint = self.specinfo.spectra_per_subint
-        self.nsubints = self.specinfo.num_subint[0]
+        self.nsubints = self.specinfo.num_subint.astype('int')
         self.freqs = self.fits['SUBINT'].data[0]['DAT_FREQ'] 
         self.frequencies = self.freqs # Alias
         self.tsamp = self.specinfo.dt 
 
+        # Polarisations to read. Their sum is returned: AA and BB
+        # give total intensity. Otherwise one polarisation is read
+        # (PSRFITS_POLN, Stokes I, or already summed data).
+        if self.specinfo.user_poln:
+            self.polns = [self.specinfo.default_poln]
+        elif (self.specinfo.num_polns >= 2) and \
+                self.specinfo.poln_order.startswith("AABB"):
+            self.polns = [0, 1]
+        else:
+            self.polns = [0]
+
+        # Position of each file (and of the padding that follows it)
+        # in the continuous stream of samples
+        self.file_nspec = self.specinfo.num_spec.astype('int')
+        self.file_npad = self.specinfo.num_pad.astype('int')
+        self.file_starts = np.concatenate(([0], \
+                np.cumsum(self.file_nspec+self.file_npad)[:-1]))
+        self.nsamp = int(self.specinfo.N)
+        self._padvals = {}
+
+        # Least-recently-used cache of decoded subints
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = OrderedDict()
+        self._cache_nbytes = 0
+
+    def clear_cache(self):
+        """Empty the subint cache and reset its hit/miss counters.
+        """
+        self._cache.clear()
+        self._cache_nbytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _cache_lookup(self, key):
+        """Return the cached, decoded subint for 'key' (a tuple of
+            file and subint indices), or None if it is not in the
+            cache.
+        """
+        if key not in self._cache:
+            self.cache_misses += 1
+            return None
+        self.cache_hits += 1
+        # Mark as most recently used
+        data = self._cache.pop(key)
+        self._cache[key] = data
+        return data
+
+    def _cache_store(self, key, data):
+        """Add a decoded subint to the cache, dropping the least
+            recently used subints if the cache is full.
+        """
+        maxbytes = self.cache_size*2**20
+        if data.nbytes > maxbytes:
+            return
+        self._cache[key] = data
+        self._cache_nbytes += data.nbytes
+        while self._cache_nbytes > maxbytes:
+            oldkey, olddata = self._cache.popitem(last=False)
+            self._cache_nbytes -= olddata.nbytes
+
+    def channel_selection(self, chans=None):
+        """Normalise a channel selection.
+
+            Input:
+                chans: None (all channels), a slice, a boolean mask
+                    with one value per channel, or an array of
+                    channel indices. Channels are numbered in the
+                    order they are stored in the file (see 'freqs').
+
+            Output:
+                sel: The selection as a slice with unit step if
+                    possible, otherwise as a sorted array of unique
+                    channel indices.
+        """
+        if chans is None:
+            return slice(0, self.nchan)
+        if isinstance(chans, slice):
+            start, stop, step = chans.indices(self.nchan)
+            if step == 1:
+                return slice(start, max(start, stop))
+            chans = np.arange(start, stop, step)
+        chans = np.asarray(chans)
+        if chans.dtype == bool:
+            assert len(chans) == self.nchan
+            chans = np.flatnonzero(chans)
+        chans = np.unique(chans)
+        assert (chans.min() >= 0) and (chans.max() < self.nchan)
+        if (chans[-1]-chans[0]+1) == len(chans):
+            return slice(chans[0], chans[-1]+1)
+        return chans
+
+    def get_subints(self, startsub, endsub, ifile=0, chans=None):
+        """Return decoded subints 'startsub' to 'endsub' (inclusive).
+            Cached subints are used first, and the missing ones
+            are decoded with read_subints in contiguous runs.
+            Only full-band subints are cached.
+
+            Inputs:
+                startsub: index of the first subint
+                endsub: index of the last subint
+                ifile: index of the file to read from. (Default: 0)
+                chans: channels to return. See channel_selection.
+                    (Default: all channels)
+
+            Output:
+                subints: list of (nsamps,nchan) float32 arrays,
+                    one per subint. Do not modify them in place.
+        """
+        sel = self.channel_selection(chans)
+        fullband = isinstance(sel, slice) and (sel == slice(0, self.nchan))
+        subints = [self._cache_lookup((ifile, isub)) for isub in \
+                    xrange(startsub, endsub+1)]
+        if not fullband:
+            subints = [data if data is None else data[:,sel] \
+                        for data in subints]
+        ii = 0
+        while ii < len(subints):
+            if subints[ii] is not None:
+                ii += 1
+                continue
+            # Find the run of missing subints starting here
+            jj = ii
+            while (jj < len(subints)) and (subints[jj] is None):
+                jj += 1
+            data = self.read_subints(startsub+ii, jj-ii, ifile=ifile, \
+                                        chans=sel)
+            data = data.reshape((jj-ii, self.nsamp_per_subint, -1))
+            for kk in xrange(ii, jj):
+                subints[kk] = data[kk-ii]
+                if fullband and (self.cache_size > 0):
+                    self._cache_store((ifile, startsub+kk), subints[kk].copy())
+            ii = jj
+        return subints
+
+    def get_padvals(self, ifile):
+        """Return the values used to pad the gap after a file:
+            the mean of each channel over the file's last subint.
+
+            Input:
+                ifile: index of the file
+
+            Output:
+                padvals: float32 array with one value per channel.
+        """
+        if ifile not in self._padvals:
+            lastsub = self.nsubints[ifile]-1
+            data = self.get_subints(lastsub, lastsub, ifile)[0]
+            self._padvals[ifile] = data.mean(axis=0)
+        return self._padvals[ifile]
+
     def read_subint(self, isub, apply_weights=True, apply_scales=True, \
-                    apply_offsets=True):
+                    apply_offsets=True, ifile=0, chans=None):
         """
         Read a PSRFITS subint from a open pyfits file object.
          Applys scales, weights, and offsets to the data.
@@ -79,111 +256,436 @@ class PsrfitsFile(object):
                     (Default: apply scales)
                 apply_offsets: If True, apply offsets. 
                     (Default: apply offsets)
+                ifile: index of the file to read from. (Default: 0)
+                chans: channels to read. See read_subints.
+                    (Default: all channels)
 
              Output: 
                 data: Subint data with scales, weights, and offsets
                      applied in float32 dtype with shape (nsamps,nchan).
         """ 
-        subintdata = self.fits['SUBINT'].data[isub]['DATA']
-        if self.nbits == 4:
-            data = unpack_4bit(subintdata)
-        else:
-            data = np.array(subintdata)
-        if apply_offsets:
-            offsets = self.get_offsets(isub)
-        else:
-            offsets = 0
-        if apply_scales:
-            scales = self.get_scales(isub)
-        else:
-            scales = 1
-        if apply_weights:
-            weights = self.get_weights(isub)
-        else:
-            weights = 1
-        data = data.reshape((self.nsamp_per_subint,self.nchan))
-        data_wso = ((data * scales) + offsets) * weights
-        return data_wso
+        return self.read_subints(isub, 1, apply_weights, apply_scales, \
+                                    apply_offsets, ifile, chans)
+
+    def read_subints(self, startsub, nsubs, apply_weights=True, \
+                    apply_scales=True, apply_offsets=True, ifile=0, \
+                    chans=None):
+        """
+        Read a range of PSRFITS subints at once. The DATA, DAT_SCL,
+         DAT_OFFS and DAT_WTS columns are sliced for the whole range
+         and the corrections are applied to all subints together.
+         Corrections that SpectraInfo found to be unnecessary are
+         skipped. Only the polarisations listed in 'polns' are
+         decoded, each with its own scales and offsets, and summed.
+
+             Inputs: 
+                startsub: index of the first subint (first subint is 0)
+                nsubs: number of subints to read
+                apply_weights: If True, apply weights. 
+                    (Default: apply weights)
+                apply_scales: If True, apply scales. 
+                    (Default: apply scales)
+                apply_offsets: If True, apply offsets. 
+                    (Default: apply offsets)
+                ifile: index of the file to read from. (Default: 0)
+                chans: channels to read. The DATA column is sliced
+                    before unpacking and scaling, so only these
+                    channels are decoded. See channel_selection.
+                    (Default: all channels)
+
+             Output: 
+                data: Subint data with scales, weights, and offsets
+                     applied in float32 dtype with shape
+                     (nsubs*nsamps,nchan).
+        """ 
+        sel = self.channel_selection(chans)
+        subints = self.fitslist[ifile]['SUBINT'].data
+        rows = slice(startsub, startsub+nsubs)
+        # Each spectrum holds the polarisations one after another
+        rawdata = subints['DATA'][rows].reshape((nsubs, \
+                                        self.nsamp_per_subint, \
+                                        self.specinfo.num_polns, -1))
+        data = None
+        for ipol in self.polns:
+            poldata = self._decode_poln(rawdata[:,:,ipol], sel)
+            # Per-channel corrections are broadcast over all samples
+            if apply_scales and self.specinfo.need_scale:
+                poldata *= self._poln_values(subints['DAT_SCL'][rows], \
+                                             ipol, sel)
+            if apply_offsets and self.specinfo.need_offset:
+                poldata += self._poln_values(subints['DAT_OFFS'][rows], \
+                                             ipol, sel)
+            if data is None:
+                data = poldata
+            else:
+                data += poldata
+        if apply_weights and self.specinfo.need_weight:
+            data *= subints['DAT_WTS'][rows][:,np.newaxis,sel]
+        return data.reshape((nsubs*self.nsamp_per_subint, -1))
+
+    def _decode_poln(self, rawdata, sel):
+        """Convert the selected channels of one polarisation of
+            raw subint data to float32.
+
+            Inputs:
+                rawdata: (nsubs, nsamps, nbytes) view of the DATA
+                    column for one polarisation.
+                sel: channel selection (see channel_selection).
 
-    def get_weights(self, isub):
+            Output:
+                data: float32 array with shape (nsubs, nsamps, nsel).
+        """
+        if self.nbits < 8:
+            # Unpack only the bytes that hold the selected channels
+            nper = 8//self.nbits
+            if isinstance(sel, slice):
+                firstchan, lastchan = sel.start, sel.stop-1
+            else:
+                firstchan, lastchan = sel[0], sel[-1]
+            firstbyte = firstchan//nper
+            rawdata = unpacking.unpack(rawdata[:,:,firstbyte:lastchan//nper+1], \
+                                        self.nbits)
+            # Channel numbers relative to the first unpacked channel
+            offset = firstbyte*nper
+            if isinstance(sel, slice):
+                sel = slice(sel.start-offset, sel.stop-offset)
+            else:
+                sel = sel-offset
+        return rawdata[:,:,sel].astype('float32')
+
+    def _poln_values(self, values, ipol, sel):
+        """Return the per-channel values (e.g. DAT_SCL) of one
+            polarisation, ready to be broadcast over the samples
+            of each subint.
+
+            Inputs:
+                values: (nsubs, npol*nchan) or (nsubs, nchan) array.
+                ipol: index of the polarisation.
+                sel: channel selection (see channel_selection).
+
+            Output:
+                values: array with shape (nsubs, 1, nsel).
+        """
+        if values.shape[-1] == self.specinfo.num_polns*self.nchan:
+            values = values.reshape((len(values), -1, self.nchan))[:,ipol]
+        return values[:,np.newaxis,sel]
+
+    def get_weights(self, isub, ifile=0):
         """Return weights for a particular subint.
 
             Inputs:
                 isub: index of subint (first subint is 0)
+                ifile: index of the file (Default: 0)
             
             Output:
                 weights: Subint weights. (There is one value for each channel)
         """
-        return self.fits['SUBINT'].data[isub]['DAT_WTS']
+        return self.fitslist[ifile]['SUBINT'].data[isub]['DAT_WTS']
 
-    def get_scales(self, isub):
+    def get_scales(self, isub, ifile=0):
         """Return scales for a particular subint.
 
             Inputs:
                 isub: index of subint (first subint is 0)
+                ifile: index of the file (Default: 0)
             
             Output:
                 scales: Subint scales. (There is one value for each channel)
         """
-        return self.fits['SUBINT'].data[isub]['DAT_SCL']
+        return self.fitslist[ifile]['SUBINT'].data[isub]['DAT_SCL']
 
-    def get_offsets(self, isub):
+    def get_offsets(self, isub, ifile=0):
         """Return offsets for a particular subint.
 
             Inputs:
                 isub: index of subint (first subint is 0)
+                ifile: index of the file (Default: 0)
             
             Output:
                 offsets: Subint offsets. (There is one value for each channel)
         """
-        return self.fits['SUBINT'].data[isub]['DAT_OFFS']
+        return self.fitslist[ifile]['SUBINT'].data[isub]['DAT_OFFS']
 
-    def get_spectra(self, startsamp, N):
+    def get_spectra(self, startsamp, N, dtype='float32', out=None, \
+                    chans=None, tdecim=1, fdecim=1):
         """Return 2D array of data from PSRFITS file.
  
             Inputs:
                 startsamp, Starting sample
                 N: number of samples to read
+                dtype: Data type of the returned spectra.
+                    (Default: float32)
+                out: Optional preallocated array to read the data
+                    into. Its shape must be that of the returned
+                    data, and its type overrides 'dtype'.
+                    (Default: allocate a new array)
+                chans: channels to read, numbered in the order of
+                    'freqs'. Only these channels are decoded. See
+                    channel_selection. (Default: all channels)
+                tdecim: Number of consecutive samples to sum into
+                    each returned sample. Samples left over at the
+                    end are dropped (like Spectra.downsample).
+                    (Default: 1)
+                fdecim: Number of adjacent channels to sum into
+                    each returned channel. Must be a factor of the
+                    number of channels read. (Default: 1)
  
             Output:
                 data: 2D numpy array
+
+            *** Decimation is applied one subint at a time while
+                decoding, so only the decimated spectra are kept
+                in memory ***
         """
-        # Calculate starting subint and ending subint
-        startsub = int(startsamp/self.nsamp_per_subint)
-        skip = startsamp - (startsub*self.nsamp_per_subint)
-        endsub = int((startsamp+N)/self.nsamp_per_subint)
-        trunc = ((endsub+1)*self.nsamp_per_subint) - (startsamp+N)
-        
-        # Read data
-        data = []
-        for isub in xrange(startsub, endsub+1):
-            data.append(self.read_subint(isub))
-        if len(data) > 1:
-            data = np.concatenate(data)
-        else:
-            data = np.array(data).squeeze()
-	data = np.transpose(data)
-        # Truncate data to desired interval
-	if trunc > 0:
-            data = data[:, skip:-trunc]
-	elif trunc == 0:
-            data = data[:, skip:]
-        else:
-            raise ValueError("Number of bins to truncate is negative: %d" % trunc)
+        if (startsamp < 0) or (startsamp+N > self.nsamp):
+            raise ValueError("Cannot read samples %d to %d " \
+                             "(observation has %d samples)" % \
+                             (startsamp, startsamp+N, self.nsamp))
+        sel = self.channel_selection(chans)
+        freqs = self.freqs[sel]
+        if len(freqs) % fdecim:
+            raise ValueError("Frequency decimation factor (%d) must be a " \
+                             "factor of the number of channels read (%d)!" % \
+                             (fdecim, len(freqs)))
+        if fdecim > 1:
+            freqs = freqs.reshape((-1, fdecim)).mean(axis=1)
         if not self.specinfo.need_flipband:
             # for psrfits module freqs go from low to high.
             # spectra module expects high frequency first.
-            data = data[::-1,:]
-            freqs = self.freqs[::-1]
+            order = slice(None, None, -1)
+            freqs = freqs[::-1]
+        else:
+            order = slice(None)
+        # Samples beyond the last whole decimated sample are not read
+        nout = N//tdecim
+        N = nout*tdecim
+        
+        if out is None:
+            spectra_data = np.empty((len(freqs), nout), dtype=dtype)
         else:
-            freqs = self.freqs 
+            assert out.shape == (len(freqs), nout)
+            spectra_data = out
+            dtype = out.dtype
+        if tdecim > 1:
+            # Decimated samples are accumulated
+            spectra_data[:] = 0
+        for ifile in xrange(self.specinfo.num_files):
+            filestart = self.file_starts[ifile]
+            fileend = filestart+self.file_nspec[ifile]
+            padend = fileend+self.file_npad[ifile]
+
+            # Copy the requested part of each subint of this file
+            # into the channel-major array
+            lo = max(startsamp, filestart)
+            hi = min(startsamp+N, fileend)
+            if lo < hi:
+                startsub = (lo-filestart)//self.nsamp_per_subint
+                endsub = (hi-1-filestart)//self.nsamp_per_subint
+                if (tdecim > 1) or (fdecim > 1):
+                    # Decode (and decimate) one subint at a time
+                    runs = [(isub, isub) for isub in \
+                                xrange(startsub, endsub+1)]
+                else:
+                    runs = [(startsub, endsub)]
+                for runstart, runend in runs:
+                    subints = self.get_subints(runstart, runend, ifile, sel)
+                    for isub, data in enumerate(subints):
+                        first = filestart + \
+                                    (runstart+isub)*self.nsamp_per_subint - \
+                                    startsamp
+                        sublo = max(-first, 0)
+                        subhi = min(N-first, self.nsamp_per_subint)
+                        _decimate_into(spectra_data, data[sublo:subhi], \
+                                       first+sublo, order, tdecim, fdecim)
+
+            # Pad the gap (if any) between this file and the next
+            lo = max(startsamp, fileend)
+            hi = min(startsamp+N, padend)
+            if lo < hi:
+                padvals = self.get_padvals(ifile)[sel]
+                pad = np.broadcast_to(padvals, (hi-lo, len(padvals)))
+                _decimate_into(spectra_data, pad, lo-startsamp, order, \
+                               tdecim, fdecim)
+
+	return spectra.Spectra(freqs, self.tsamp*tdecim, spectra_data, \
+                               starttime=self.tsamp*startsamp, dm=0, \
+                               dtype=dtype)
+
+    def iter_spectra(self, blocklen, overlap=0, startsamp=0, endsamp=None, \
+                        dtype='float32', chans=None):
+        """Iterate over the observation in blocks of spectra.
+            Consecutive blocks overlap by 'overlap' samples (e.g. the
+            dispersion delay across the band at the largest DM of
+            interest). The overlapping samples are copied from the
+            previous block rather than decoded again.
+ 
+            Inputs:
+                blocklen: number of samples per block
+                overlap: number of samples shared by consecutive
+                    blocks. Must be smaller than 'blocklen'.
+                    (Default: 0)
+                startsamp: first sample to read (Default: 0)
+                endsamp: sample to stop reading at
+                    (Default: end of the observation)
+                dtype: Data type of the spectra. (Default: float32)
+                chans: channels to read. See get_spectra.
+                    (Default: all channels)
+ 
+            Output:
+                A generator of Spectra objects. All blocks are
+                    'blocklen' samples long, except possibly the last.
+
+            *** The data of every block are a view of one buffer
+                that is overwritten when the next block is read.
+                Copy them (e.g. with np.array) to keep them longer.
+                Blocks may be modified in place (e.g. dedispersed):
+                the overlap is kept in a separate buffer, so this
+                does not change the next block ***
+        """
+        assert 0 <= overlap < blocklen
+        if endsamp is None:
+            endsamp = self.nsamp
+        step = blocklen-overlap
+        sel = self.channel_selection(chans)
+        nchan = len(np.arange(self.nchan)[sel])
+        buf = np.empty((nchan, blocklen), dtype=dtype)
+        # The overlap is saved here before a block is handed out
+        keep = np.empty((nchan, overlap), dtype=dtype)
+        start = startsamp
+        nkeep = 0
+        while start < endsamp:
+            N = min(blocklen, endsamp-start)
+            if nkeep:
+                # Start with the end of the previous block
+                buf[:,:nkeep] = keep
+            block = self.get_spectra(start+nkeep, N-nkeep, \
+                                     out=buf[:,nkeep:N], chans=sel)
+            last = (start+N >= endsamp)
+            if overlap and not last:
+                keep[:] = buf[:,step:step+overlap]
+            yield spectra.Spectra(block.freqs, self.tsamp, buf[:,:N], \
+                                  starttime=self.tsamp*start, dm=0, \
+                                  dtype=dtype)
+            if last:
+                break
+            start += step
+            nkeep = overlap
 
-	return spectra.Spectra(freqs, self.tsamp, data, \
-                               starttime=self.tsamp*startsamp, dm=0)
+
+def _decimate_into(out, data, first, order, tdecim=1, fdecim=1):
+    """Add decoded spectra to a (possibly decimated) channel-major
+        array. Decimated samples that straddle the edge of 'data'
+        are partially summed, so consecutive calls complete them.
+
+        Inputs:
+            out: (nchan/fdecim, nsamp/tdecim) output array. It must
+                be zeroed beforehand if 'tdecim' is larger than 1.
+            data: (nsamp, nchan) array of spectra in file order.
+            first: index (before decimation) of the first sample
+                of 'data' in the output.
+            order: Slice to put the channels in output order.
+            tdecim: Time decimation factor. (Default: 1)
+            fdecim: Frequency decimation factor. (Default: 1)
+
+        Outputs:
+            None - 'out' is modified in place.
+    """
+    if fdecim > 1:
+        data = data.reshape((len(data), -1, fdecim)).sum(axis=2)
+    data = data[:,order]
+    if tdecim == 1:
+        out[:,first:first+len(data)] = data.T
+        return
+    last = first+len(data)
+    # Decimated samples entirely within 'data'
+    jlo = -(-first//tdecim)
+    jhi = min(last//tdecim, out.shape[1])
+    if jlo < jhi:
+        whole = data[jlo*tdecim-first:jhi*tdecim-first]
+        out[:,jlo:jhi] += whole.reshape((jhi-jlo, tdecim, -1)).sum(axis=1).T
+    # Decimated samples only partly within 'data'
+    for jj in set([first//tdecim, (last-1)//tdecim]):
+        if (jj < out.shape[1]) and not (jlo <= jj < jhi):
+            lo = max(jj*tdecim, first)
+            hi = min((jj+1)*tdecim, last)
+            out[:,jj] += data[lo-first:hi-first].sum(axis=0)
+
+
+def _header_cache_key(filenames):
+    """Return the key that identifies the header cache of a set of
+        files: the path, size and modification time of each file
+        (and the PSRFITS_POLN setting, which SpectraInfo uses).
+    """
+    key = []
+    for fn in filenames:
+        st = os.stat(fn)
+        key.append((os.path.abspath(fn), st.st_size, st.st_mtime))
+    return (tuple(key), os.getenv("PSRFITS_POLN"))
 
 
 class SpectraInfo:
-    def __init__(self, filenames):
+    def __init__(self, filenames, hdus=None, cache=False):
+        """SpectraInfo constructor.
+
+            Inputs:
+                filenames: Names of the PSRFITS files.
+                hdus: Already opened HDU lists, one per file. If not
+                    given the files are opened (and closed again).
+                    (Default: None)
+                cache: If True, read the header information from (or
+                    save it to) a '.specinfo.pkl' sidecar next to the
+                    first file. The sidecar is only used if the path,
+                    size and modification time of every file match.
+                    (Default: False)
+
+            Output:
+                specinfo: SpectraInfo object.
+        """
+        if cache:
+            cachefn = os.path.splitext(filenames[0])[0]+".specinfo.pkl"
+            key = _header_cache_key(filenames)
+            if self._load_cache(cachefn, key):
+                return
+        self._parse(filenames, hdus)
+        if cache:
+            self._save_cache(cachefn, key)
+
+    def _load_cache(self, cachefn, key):
+        """Fill in the header information from the cache file
+            'cachefn' if it was made for 'key'. Return True if
+            the cache was used.
+        """
+        if not os.path.isfile(cachefn):
+            return False
+        try:
+            f = open(cachefn, 'rb')
+            try:
+                cached = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            # An unreadable cache is simply rebuilt
+            return False
+        if cached.get('key') != key:
+            return False
+        self.__dict__.update(cached['info'])
+        return True
+
+    def _save_cache(self, cachefn, key):
+        """Save the header information to the cache file 'cachefn'.
+        """
+        try:
+            tmpfn = cachefn+".tmp"
+            with open(tmpfn, 'wb') as f:
+                cPickle.dump({'key': key, 'info': self.__dict__}, f, 2)
+            os.rename(tmpfn, cachefn)
+        except (IOError, OSError):
+            # Caching is only an optimisation (e.g. read-only directories)
+            pass
+
+    def _parse(self, filenames, hdus=None):
+        """Collect the header information from the PSRFITS files.
+        """
         self.filenames = filenames
         self.num_files = len(filenames)
         self.N = 0
@@ -205,16 +707,19 @@ class SpectraInfo:
         self.need_flipband = False
 
         for ii, fn in enumerate(filenames):
-            if not is_PSRFITS(fn):
+            # Open the PSRFITS file (unless it is open already)
+            if hdus is None:
+                filehdus = pyfits.open(fn, mode='readonly')
+            else:
+                filehdus = hdus[ii]
+
+            if not is_PSRFITS(fn, filehdus):
                 raise ValueError("File '%s' does not appear to be PSRFITS!" % fn)
             
-            # Open the PSRFITS file
-            hdus = pyfits.open(fn, mode='readonly')
-            
             if ii==0:
-                self.hdu_names = [hdu.name for hdu in hdus]
+                self.hdu_names = [hdu.name for hdu in filehdus]
 
-            primary = hdus['PRIMARY'].header
+            primary = filehdus['PRIMARY'].header
 
             if 'TELESCOP' not in primary.keys():
                 telescope = ""
@@ -226,7 +731,7 @@ class SpectraInfo:
             if ii == 0:
                 self.telescope = telescope
             else:
-                if telescope != self.telescope[0]:
+                if telescope != self.telescope:
                     warnings.warn("'TELESCOP' values don't match for files 0 and %d!" % ii)
 
             self.observer = primary['OBSERVER']
@@ -261,7 +766,7 @@ class SpectraInfo:
                     warnings.warn("'TRK_MODE' values don't match for files 0 and %d" % ii)
 
             # Now switch to the subint HDU header
-            subint = hdus['SUBINT'].header
+            subint = filehdus['SUBINT'].header
             
             self.dt = subint['TBIN']
             self.num_channels = subint['NCHAN']
@@ -299,7 +804,9 @@ class SpectraInfo:
             self.start_spec[ii] = (MJDf * psr_utils.SECPERDAY / self.dt + 0.5)
 
             # Now pull stuff from the columns
-            subint_hdu = hdus['SUBINT']
+            subint_hdu = filehdus['SUBINT']
+            # The first row is used to inspect the columns below
+            firstrow = subint_hdu.data[0]
             # Identify the OFFS_SUB column number
             if 'OFFS_SUB' not in subint_hdu.columns.names:
                 warnings.warn("Can't find the 'OFFS_SUB' column!")
@@ -328,7 +835,7 @@ class SpectraInfo:
                 colnum = subint_hdu.columns.names.index('TEL_AZ')
                 if ii==0:
                     self.tel_az_col = colnum
-                    self.azimuth = subint_hdu.data[0]['TEL_AZ']
+                    self.azimuth = firstrow['TEL_AZ']
 
             # Telescope zenith angle
             if 'TEL_ZEN' not in subint_hdu.columns.names:
@@ -337,14 +844,14 @@ class SpectraInfo:
                 colnum = subint_hdu.columns.names.index('TEL_ZEN')
                 if ii==0:
                     self.tel_zen_col = colnum
-                    self.zenith_ang = subint_hdu.data[0]['TEL_ZEN']
+                    self.zenith_ang = firstrow['TEL_ZEN']
 
             # Observing frequencies
             if 'DAT_FREQ' not in subint_hdu.columns.names:
                 warnings.warn("Can't find the channel freq column, 'DAT_FREQ'!")
             else:
                 colnum = subint_hdu.columns.names.index('DAT_FREQ')
-                freqs = subint_hdu.data[0]['DAT_FREQ']
+                freqs = firstrow['DAT_FREQ']
                 if ii==0:
                     self.freqs_col = colnum
                     self.df = freqs[1]-freqs[0]
@@ -374,7 +881,7 @@ class SpectraInfo:
                     self.dat_wts_col = colnum
                 elif self.dat_wts_col != colnum:
                     warnings.warn("'DAT_WTS column changes between files 0 and %d!" % ii)
-                if np.any(subint_hdu.data[0]['DAT_WTS'] != 1.0):
+                if np.any(firstrow['DAT_WTS'] != 1.0):
                     self.need_weight = True
                 
             # Data offsets
@@ -386,7 +893,7 @@ class SpectraInfo:
                     self.dat_offs_col = colnum
                 elif self.dat_offs_col != colnum:
                     warnings.warn("'DAT_OFFS column changes between files 0 and %d!" % ii)
-                if np.any(subint_hdu.data[0]['DAT_OFFS'] != 0.0):
+                if np.any(firstrow['DAT_OFFS'] != 0.0):
                     self.need_offset = True
 
             # Data scalings
@@ -398,7 +905,7 @@ class SpectraInfo:
                     self.dat_scl_col = colnum
                 elif self.dat_scl_col != colnum:
                     warnings.warn("'DAT_SCL' column changes between files 0 and %d!" % ii)
-                if np.any(subint_hdu.data[0]['DAT_SCL'] != 1.0):
+                if np.any(firstrow['DAT_SCL'] != 1.0):
                     self.need_scale = True
 
             # Comute the samples per file and the amount of padding
@@ -411,8 +918,12 @@ class SpectraInfo:
                     self.N += self.num_pad[ii-1]
             self.N += self.num_spec[ii]
 
+            if hdus is None:
+                filehdus.close()
+
         # Finished looping through PSRFITS files. Finalise a few things.
         # Convert the position strings into degrees        
+        import astro_utils.protractor as protractor
         self.ra2000 = protractor.convert(self.ra_str, 'hmsstr', 'deg')
         self.dec2000 = protractor.convert(self.dec_str, 'dmsstr', 'deg')
         
@@ -528,6 +1039,7 @@ def DATEOBS_to_MJD(dateobs):
         Returns a 2-tuple:
             (integer part of MJD, fractional part of MJD)
     """
+    import pyslalib.slalib as slalib
     # Parse string using regular expression defined at top of file
     m = date_obs_re.match(dateobs)
     mjd_fracday = (float(m.group("hour")) + (float(m.group("min")) + \
@@ -537,12 +1049,18 @@ def DATEOBS_to_MJD(dateobs):
     return mjd_day, mjd_fracday
 
 
-def is_PSRFITS(filename):
+def is_PSRFITS(filename, hdus=None):
     """Return True if filename appears to be PSRFITS format.
         Return False otherwise.
+
+        If 'hdus' (the already opened file) is given, the file
+        is not opened again.
     """
-    hdus = pyfits.open(filename, mode='readonly')
-    primary = hdus['PRIMARY'].header
+    if hdus is None:
+        filehdus = pyfits.open(filename, mode='readonly')
+    else:
+        filehdus = hdus
+    primary = filehdus['PRIMARY'].header
 
     try:
         isPSRFITS = ((primary['FITSTYPE'] == "PSRFITS") and \
@@ -550,7 +1068,8 @@ def is_PSRFITS(filename):
     except KeyError:
         isPSRFITS = False
     
-    hdus.close() 
+    if hdus is None:
+        filehdus.close() 
     return isPSRFITS
 
 
@@ -1,14 +1,399 @@
 import copy
+import os
+import weakref
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
-import scipy.signal
-import psr_utils
+
+# Number of array elements handled at a time by the kernels that
+# work on blocks of channels.
+BLOCK_SIZE = 2**17
+
+# Number of threads that channel blocks are spread over. This can
+# be set with the SP_NUM_THREADS environment variable or with
+# set_num_threads.
+_num_threads = int(os.environ.get('SP_NUM_THREADS', 1))
+_pool = None
+
+
+def set_num_threads(num_threads):
+    """Set the number of threads used by the channel-parallel
+        Spectra operations (shifting, smoothing, masking and
+        the fused processing). 1 disables threading.
+
+        Input:
+            num_threads: Number of worker threads.
+
+        Output:
+            None
+    """
+    global _num_threads, _pool
+    if num_threads < 1:
+        raise ValueError("Number of threads must be at least 1 " \
+                            "(not %d)" % num_threads)
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+    _num_threads = int(num_threads)
+
+
+def get_num_threads():
+    """Return the number of threads used by the channel-parallel
+        Spectra operations.
+    """
+    return _num_threads
+
+
+def _map_blocks(func, blocks):
+    """Call 'func' on each of 'blocks', spreading the calls over
+        the thread pool if more than one thread is in use.
+        Returns the list of results.
+    """
+    global _pool
+    blocks = list(blocks)
+    if (_num_threads <= 1) or (len(blocks) <= 1):
+        return [func(blk) for blk in blocks]
+    if _pool is None:
+        _pool = ThreadPool(_num_threads)
+    return _pool.map(func, blocks)
+
+
+def _pad_values(data, padval):
+    """Return the padding value of each channel (row) of 'data'.
+
+        Inputs:
+            data: A 2D numpy array with channels along axis 0.
+            padval: A numeric value, 'mean' or 'median'.
+
+        Output:
+            pads: A 1D array with one padding value per channel.
+    """
+    if padval=='mean':
+        return np.mean(data, axis=1)
+    elif padval=='median':
+        return np.median(data, axis=1)
+    else:
+        return np.ones(data.shape[0])*padval
+
+
+def _channel_blocks(numchans, numspectra):
+    """Yield slices that split 'numchans' channels into blocks
+        of roughly BLOCK_SIZE elements each.
+    """
+    step = max(1, BLOCK_SIZE//max(1, numspectra))
+    for start in range(0, numchans, step):
+        yield slice(start, min(start+step, numchans))
+
+
+def _shift_rows(data, bins, padval):
+    """Shift each row of 'data' to the left by the corresponding
+        value in 'bins'. See Spectra.shift_channels for the meaning
+        of 'padval'.
+
+        Inputs:
+            data: A 2D numpy array with channels along axis 0.
+            bins: An integer array with one shift per channel.
+            padval: A numeric value, 'median', 'mean' or 'rotate'.
+
+        Output:
+            None
+
+        *** Shifting happens in-place ***
+    """
+    numspectra = data.shape[1]
+    def shift_block(blk):
+        # Each row is rotated through a row-sized scratch buffer
+        # (shared by the rows of the block) with two slice copies.
+        # This is faster than a fancy-indexed gather over the whole
+        # array.
+        scratch = np.empty(numspectra, dtype=data.dtype)
+        for ii in range(blk.start, blk.stop):
+            shift = bins[ii] % numspectra
+            if shift:
+                scratch[:numspectra-shift] = data[ii,shift:]
+                scratch[numspectra-shift:] = data[ii,:shift]
+                data[ii] = scratch
+        if padval != 'rotate':
+            # The padding values of all channels in the (cache-sized)
+            # block come from a single reduction over the rotated rows.
+            pads = _pad_values(data[blk], padval)
+            for ii in range(blk.start, blk.stop):
+                if bins[ii] > 0:
+                    data[ii,-bins[ii]:] = pads[ii-blk.start]
+                elif bins[ii] < 0:
+                    data[ii,:-bins[ii]] = pads[ii-blk.start]
+    _map_blocks(shift_block, _channel_blocks(data.shape[0], numspectra))
+
+
+def _subband_sum(data, nsub, out=None):
+    """Sum groups of adjacent channels of 'data' into 'nsub' subbands.
+        The reduction runs on a reshaped view of 'data', so no
+        intermediate copies are made.
+
+        Inputs:
+            data: A 2D numpy array with channels along axis 0.
+            nsub: Number of subbands. Must be a factor of the
+                number of channels.
+            out: Optional preallocated output array of shape
+                (nsub, data.shape[1]). (Default: allocate one)
+
+        Output:
+            subbanded: The subbanded 2D array.
+    """
+    numchans, numspectra = data.shape
+    return data.reshape((nsub, numchans//nsub, numspectra)).sum(axis=1, out=out)
+
+
+def _downsample_sum(data, factor, out=None):
+    """Co-add 'factor' adjacent samples of each channel of 'data'.
+        Excess samples at the end of the data are ignored. The
+        reduction runs on a reshaped view of 'data', so no
+        intermediate copies are made.
+
+        Inputs:
+            data: A 2D numpy array with channels along axis 0.
+            factor: Number of adjacent samples to co-add.
+            out: Optional preallocated output array of shape
+                (data.shape[0], data.shape[1]//factor).
+                (Default: allocate one)
+
+        Output:
+            downsampled: The downsampled 2D array.
+    """
+    numchans, numspectra = data.shape
+    nout = numspectra//factor
+    return data[:,:nout*factor].reshape((numchans, nout, factor)).sum(axis=2, out=out)
+
+
+def _boxcar_smooth(data, width, padval):
+    """Smooth each row of 'data' with a top hat of the given width,
+        normalised such that RMS=1 after smoothing. The output is
+        the same as convolving each padded row with the top hat
+        ('same' mode), but is computed from cumulative sums so that
+        the cost does not depend on 'width'.
+
+        Inputs:
+            data: A 2D numpy array.
+            width: Number of bins to smooth by.
+            padval: Padding value to use beyond the ends of each
+                row. Possible values are float-value, 'mean',
+                'median', 'wrap'.
+
+        Output:
+            smoothed: The smoothed data (float64).
+    """
+    numchans, numspectra = data.shape
+    csum = np.zeros((numchans, numspectra+1))
+    np.cumsum(data, axis=1, dtype=np.float64, out=csum[:,1:])
+    smoothed = np.empty((numchans, numspectra))
+    # Output bin t is the sum of bins [t-width//2, t-width//2+width).
+    # Away from the ends this is a difference of two slices...
+    nfull = max(numspectra+1-width, 0)
+    first = min(width//2, numspectra)
+    np.subtract(csum[:,width:width+nfull], csum[:,:nfull], \
+                out=smoothed[:,first:first+nfull])
+    # ...while near the ends part of the window is padding.
+    edges = np.r_[0:first, first+nfull:numspectra]
+    lo = edges-width//2
+    hi = lo+width
+    inlo = np.clip(lo, 0, numspectra)
+    inhi = np.clip(hi, 0, numspectra)
+    edgesum = csum[:,inhi]-csum[:,inlo]
+    if padval=='wrap':
+        # Bins before the start come from the end, and vice versa
+        edgesum += csum[:,[numspectra]] - \
+                    csum[:,np.clip(numspectra+lo, 0, numspectra)]
+        edgesum += csum[:,np.clip(hi-numspectra, 0, numspectra)]
+    else:
+        npad = width-(inhi-inlo)
+        edgesum += _pad_values(data, padval)[:,np.newaxis]*npad
+    smoothed[:,edges] = edgesum
+    smoothed /= np.sqrt(width)
+    return smoothed
+
+
+def _shift_row(row, shift, padval, out, sub=None):
+    """Write 'row' shifted to the left by 'shift' bins into 'out'.
+        This is the single-channel equivalent of _shift_rows.
+
+        Inputs:
+            row: A 1D numpy array.
+            shift: Number of bins to shift by.
+            padval: A numeric value, 'median', 'mean' or 'rotate'.
+            out: Output array. Must have the same length as 'row'
+                and must not overlap it.
+            sub: Optional 1D array to subtract from 'row' while
+                shifting. (Default: subtract nothing)
+
+        Output:
+            None
+    """
+    numspectra = len(row)
+    rot = shift % numspectra
+    if sub is None:
+        out[:numspectra-rot] = row[rot:]
+        out[numspectra-rot:] = row[:rot]
+    else:
+        np.subtract(row[rot:], sub[rot:], out=out[:numspectra-rot])
+        np.subtract(row[:rot], sub[:rot], out=out[numspectra-rot:])
+    if (padval != 'rotate') and shift:
+        pad = _pad_values(out[np.newaxis], padval)[0]
+        if shift > 0:
+            out[-shift:] = pad
+        else:
+            out[:-shift] = pad
+
+
+# DelayTable objects, keyed by frequency layout and sample time
+_delay_tables = {}
+
+
+class DelayTable(object):
+    """Dispersion delays for a given set of channel frequencies
+        and sample time. The frequency dependent (nu^-2) part of
+        the delays is computed once, so that the bin shifts for a
+        given DM only need a multiply and a round. Shifts are
+        also memoised per DM.
+
+        Use DelayTable.get(freqs, dt) to share tables between
+        Spectra objects with the same frequency layout.
+    """
+    def __init__(self, freqs, dt):
+        """DelayTable constructor.
+
+            Inputs:
+                freqs: Observing frequencies for each channel.
+                dt: Sample time (in seconds).
+
+            Output:
+                table: DelayTable object.
+        """
+        self.freqs = np.array(freqs, dtype='float64')
+        self.dt = dt
+        # PRESTO is only loaded once delays are needed
+        import psr_utils
+        # Delay (in bins) at DM = 1 pc/cm^3
+        self.unit_delays = psr_utils.delay_from_DM(1.0, self.freqs)/dt
+        self._factors = {}
+        self._bindelays = {}
+
+    @classmethod
+    def get(cls, freqs, dt):
+        """Return the (shared) DelayTable for 'freqs' and 'dt'.
+        """
+        freqs = np.asarray(freqs, dtype='float64')
+        key = (freqs.tostring(), dt)
+        if key not in _delay_tables:
+            _delay_tables[key] = cls(freqs, dt)
+        return _delay_tables[key]
+
+    @property
+    def dmfac(self):
+        """Delay (in seconds) across the band per unit DM.
+        """
+        return 4.15e3 * np.abs(1./self.freqs[0]**2 - 1./self.freqs[-1]**2)
+
+    def _rel_factors(self, nsub):
+        # Delays (in bins, at DM = 1) relative to the highest
+        # frequency of the band (nsub=None) or of each subband
+        if nsub not in self._factors:
+            if nsub is None:
+                ref_delays = self.unit_delays.min()
+            else:
+                nchan_per_sub = len(self.freqs)//nsub
+                ref_delays = self.unit_delays[np.arange(nsub)*nchan_per_sub]
+                ref_delays = ref_delays.repeat(nchan_per_sub)
+            self._factors[nsub] = self.unit_delays-ref_delays
+        return self._factors[nsub]
+
+    def bindelays(self, dm, nsub=None):
+        """Return the shift (in bins) of each channel at DM 'dm'.
+
+            Inputs:
+                dm: The DM (in pc/cm^3).
+                nsub: If given, shifts align the channels within
+                    each of 'nsub' subbands to the highest frequency
+                    of the subband. Otherwise shifts are relative to
+                    the highest frequency of the band. (Default: None)
+
+            Output:
+                bindelays: Integer array of shifts, one per channel.
+                    This array is shared; do not modify it.
+        """
+        key = (dm, nsub)
+        if key not in self._bindelays:
+            bins = np.round(dm*self._rel_factors(nsub)).astype('int')
+            self._bindelays[key] = bins
+        return self._bindelays[key]
+
+
+def _subband_freqs(freqs, nsub):
+    """Return the centre frequencies of 'nsub' subbands of 'freqs'.
+    """
+    nchan_per_sub = len(freqs)//nsub
+    sub_hifreqs = freqs[np.arange(nsub)*nchan_per_sub]
+    sub_lofreqs = freqs[(1+np.arange(nsub))*nchan_per_sub-1]
+    return 0.5*(sub_hifreqs+sub_lofreqs)
+
+
+class ProcessingPlan(object):
+    """The chain of operations used to make a waterfall plot.
+        The operations are applied in the following order:
+        zero-DM filtering, subbanding, dedispersion,
+        downsampling, scaling and smoothing.
+    """
+    def __init__(self, zerodm=False, nsub=None, subdm=None, dm=None, \
+                    downsamp=1, scaleindep=False, width_bins=1, padval='mean', \
+                    dtype=None):
+        """ProcessingPlan constructor.
+
+            Inputs:
+                zerodm: If True, subtract the mean over channels from
+                    each spectrum. (Default: False)
+                nsub: Number of subbands. Subbanding is only done if
+                    both 'nsub' and 'subdm' are given. (Default: None)
+                subdm: DM to use when subbanding. (Default: None)
+                dm: DM to dedisperse to. (Default: don't dedisperse)
+                downsamp: Downsampling factor. (Default: 1)
+                scaleindep: If True, scale each channel independently.
+                    See Spectra.scaled. (Default: False)
+                width_bins: Width (in downsampled bins) of the boxcar
+                    to smooth with. (Default: don't smooth)
+                padval: The padding value to use when shifting and
+                    smoothing. See Spectra.shift_channels.
+                    (Default: 'mean')
+                dtype: Data type of the processed spectra.
+                    (Default: same as the input spectra)
+
+            Output:
+                plan: ProcessingPlan object.
+        """
+        self.zerodm = zerodm
+        self.nsub = nsub
+        self.subdm = subdm
+        self.dm = dm
+        self.downsamp = downsamp
+        self.scaleindep = scaleindep
+        self.width_bins = width_bins
+        self.padval = padval
+        self.dtype = dtype
+
+    def __eq__(self, other):
+        return isinstance(other, ProcessingPlan) and \
+                (self.__dict__ == other.__dict__)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash(tuple(sorted(self.__dict__.items())))
+
 
 class Spectra(object):
     """A class to store spectra. This is mainly to provide
         reusable functionality.
     """
-    def __init__(self, freqs, dt, data, starttime=0, dm=0):
+    def __init__(self, freqs, dt, data, starttime=0, dm=0, dtype='float32'):
         """Spectra constructor.
             
             Inputs:
@@ -21,6 +406,9 @@ class Spectra(object):
                         with respect to the start of the observation.
                         (Default: 0).
                 dm: Dispersion measure (in pc/cm^3). (Default: 0)
+                dtype: Data type to store the spectra as. 'data' is
+                        only copied if it is not already of this type.
+                        (Default: float32)
 
             Output:
                 spectra_obj: Spectrum object.
@@ -29,7 +417,7 @@ class Spectra(object):
         assert len(freqs)==self.numchans
 
         self.freqs = freqs
-        self.data = data.astype('float')
+        self.data = np.asarray(data, dtype=dtype)
         self.dt = dt
         self.starttime = starttime
         self.dm = 0
@@ -71,27 +459,9 @@ class Spectra(object):
             *** Shifting happens in-place ***
         """
         assert self.numchans == len(bins)
-        for ii in range(self.numchans):
-            chan = self.get_chan(ii)
-            # Use 'chan[:]' so update happens in-place
-            # this way the change effects self.data
-            chan[:] = psr_utils.rotate(chan, bins[ii])
-            if padval!='rotate':
-                # Get padding value
-                if padval=='mean':
-                    pad = np.mean(chan)
-                elif padval=='median':
-                    pad = np.median(chan)
-                else:
-                    pad = padval
-                
-                # Replace rotated values with padval
-                if bins[ii]>0:
-                    chan[-bins[ii]:] = pad
-                elif bins[ii]<0:
-                    chan[:-bins[ii]] = pad
+        _shift_rows(self.data, np.asarray(bins, dtype='int'), padval)
 
-    def subband(self, nsub, subdm=None, padval=0):
+    def subband(self, nsub, subdm=None, padval=0, out=None):
         """Reduce the number of channels to 'nsub' by subbanding.
             The channels within a subband are combined using the
             DM 'subdm'. 'padval' is passed to the call to
@@ -106,6 +476,9 @@ class Spectra(object):
                 padval: The padding value to use when shifting
                     channels during dedispersion. See documentation
                     of Spectra.shift_channels. (Default: 0)
+                out: Optional preallocated array of shape
+                    (nsub, numspectra) to hold the subbanded data.
+                    (Default: allocate a new array)
 
             Outputs:
                 None
@@ -114,27 +487,21 @@ class Spectra(object):
         """
         assert (self.numchans % nsub) == 0
         assert (subdm is None) or (subdm >= 0)
-        nchan_per_sub = self.numchans/nsub
-        sub_hifreqs = self.freqs[np.arange(nsub)*nchan_per_sub]
-        sub_lofreqs = self.freqs[(1+np.arange(nsub))*nchan_per_sub-1]
-        sub_ctrfreqs = 0.5*(sub_hifreqs+sub_lofreqs)
+        sub_ctrfreqs = _subband_freqs(self.freqs, nsub)
         
         if subdm is not None:
             # Compute delays
-            ref_delays = psr_utils.delay_from_DM(subdm-self.dm, sub_hifreqs)
-            delays = psr_utils.delay_from_DM(subdm-self.dm, self.freqs)
-            rel_delays = delays-ref_delays.repeat(nchan_per_sub) # Relative delay
-            rel_bindelays = np.round(rel_delays/self.dt).astype('int')
+            rel_bindelays = DelayTable.get(self.freqs, self.dt).bindelays( \
+                                                subdm-self.dm, nsub)
             # Shift channels
             self.shift_channels(rel_bindelays, padval)
 
         # Subband
-        self.data = np.array([np.sum(sub, axis=0) for sub in \
-                                np.vsplit(self.data, nsub)])
+        self.data = _subband_sum(self.data, nsub, out)
         self.freqs = sub_ctrfreqs
         self.numchans = nsub
 
-    def scaled(self, indep=False):
+    def scaled(self, indep=False, inplace=False):
         """Return a scaled version of the Spectra object.
             When scaling subtract the median from each channel,
             and divide by global std deviation (if indep==False), or
@@ -143,23 +510,29 @@ class Spectra(object):
             Input:
                 indep: Boolean. If True, scale each row
                     independantly (Default: False).
+                inplace: Boolean. If True, scale the data of this
+                    Spectra object and return it rather than a
+                    scaled copy. (Default: False)
 
             Output:
                 scaled_spectra: A scaled version of the
                     Spectra object.
         """
-        other = copy.deepcopy(self)
         if not indep:
-            std = other.data.std()
-        for ii in range(other.numchans):
-            chan = other.get_chan(ii)
-            median = np.median(chan)
-            if indep:
-                std = chan.std()
-            chan[:] = (chan-median)/std
+            std = self.data.std()
+        else:
+            std = self.data.std(axis=1)[:,np.newaxis]
+        median = np.median(self.data, axis=1)[:,np.newaxis]
+        if inplace:
+            other = self
+            other.data -= median
+        else:
+            other = copy.copy(self)
+            other.data = self.data - median
+        other.data /= std
         return other
     
-    def scaled2(self, indep=False):
+    def scaled2(self, indep=False, inplace=False):
         """Return a scaled version of the Spectra object.
             When scaling subtract the min from each channel,
             and divide by global max (if indep==False), or
@@ -168,20 +541,26 @@ class Spectra(object):
             Input:
                 indep: Boolean. If True, scale each row
                     independantly (Default: False).
+                inplace: Boolean. If True, scale the data of this
+                    Spectra object and return it rather than a
+                    scaled copy. (Default: False)
 
             Output:
                 scaled_spectra: A scaled version of the
                     Spectra object.
         """
-        other = copy.deepcopy(self)
         if not indep:
-            max = other.data.max()
-        for ii in range(other.numchans):
-            chan = other.get_chan(ii)
-            min = chan.min()
-            if indep:
-                max = chan.max()
-            chan[:] = (chan-min)/max
+            max = self.data.max()
+        else:
+            max = self.data.max(axis=1)[:,np.newaxis]
+        min = self.data.min(axis=1)[:,np.newaxis]
+        if inplace:
+            other = self
+            other.data -= min
+        else:
+            other = copy.copy(self)
+            other.data = self.data - min
+        other.data /= max
         return other
 
     def masked(self, mask, maskval='median-mid80'):
@@ -204,21 +583,30 @@ class Spectra(object):
                 maskedspec: A masked version of the Spectra object.
         """
         assert self.data.shape == mask.shape
-        maskvals = np.ones(self.numchans)
-        for ii in range(self.numchans):
-            chan = self.get_chan(ii)
-            # Use 'chan[:]' so update happens in-place
+        # Only channels that are entirely masked are replaced
+        chans = np.flatnonzero(mask.all(axis=1))
+        if not len(chans):
+            return self
+        def maskvals_block(blk):
+            masked = self.data[chans[blk]]
             if maskval=='mean':
-                maskvals[ii]=np.mean(chan)
+                return masked.mean(axis=1)
             elif maskval=='median':
-                maskvals[ii]=np.median(chan)
+                return np.median(masked, axis=1)
             elif maskval=='median-mid80':
+                # Select the middle element(s) of the trimmed, sorted
+                # channels without sorting them
                 n = int(np.round(0.1*self.numspectra))
-                maskvals[ii]=np.median(sorted(chan)[n:-n])
+                nkeep = self.numspectra-2*n
+                lo = n+(nkeep-1)//2
+                hi = n+nkeep//2
+                masked = np.partition(masked, (lo, hi), axis=1)
+                return 0.5*(masked[:,lo]+masked[:,hi])
             else:
-                maskvals[ii]=maskval
-            if np.all(mask[ii]):
-                self.data[ii] = np.ones_like(self.data[ii])*(maskvals[:,np.newaxis][ii])
+                return np.ones(len(masked))*maskval
+        maskvals = np.concatenate(_map_blocks(maskvals_block, \
+                                _channel_blocks(len(chans), self.numspectra)))
+        self.data[chans] = maskvals[:,np.newaxis]
         return self
 
     def dedisperse(self, dm=0, padval=0):
@@ -237,10 +625,7 @@ class Spectra(object):
             *** Dedispersion happens in place ***
         """
         assert dm >= 0
-        ref_delay = psr_utils.delay_from_DM(dm-self.dm, np.max(self.freqs))
-        delays = psr_utils.delay_from_DM(dm-self.dm, self.freqs)
-        rel_delays = delays-ref_delay # Relative delay
-        rel_bindelays = np.round(rel_delays/self.dt).astype('int')
+        rel_bindelays = DelayTable.get(self.freqs, self.dt).bindelays(dm-self.dm)
         # Shift channels
         self.shift_channels(rel_bindelays, padval)
 
@@ -261,34 +646,106 @@ class Spectra(object):
             Ouputs:
                 None
 
-            This bit of code is taken from Scott Ransom's
-            PRESTO's single_pulse_search.py (line ~ 423).
+            This is equivalent to the padded convolution in Scott
+            Ransom's PRESTO's single_pulse_search.py (line ~ 423),
+            computed from cumulative sums of all channels at once.
             
             *** Smoothing is done in place. ***
         """
         if width > 1:
-            kernel = np.ones(width, dtype='float32')/np.sqrt(width)
-            for ii in range(self.numchans):
-                chan = self.get_chan(ii)
-                if padval=='wrap':
-                    tosmooth = np.concatenate([chan[-width:], \
-                                chan, chan[:width]])
-                elif padval=='mean':
-                    tosmooth = np.ones(self.numspectra+width*2) * \
-                                np.mean(chan)
-                    tosmooth[width:-width] = chan
-                elif padval=='median':
-                    tosmooth = np.ones(self.numspectra+width*2) * \
-                                np.median(chan)
-                    tosmooth[width:-width] = chan
-                else: # padval is a float
-                    tosmooth = np.ones(self.numspectra+width*2) * \
-                                padval
-                    tosmooth[width:-width] = chan
-                    
-                smoothed = scipy.signal.convolve(tosmooth, kernel, 'same')
-                chan[:] = smoothed[width:-width]
+            def smooth_block(blk):
+                self.data[blk] = _boxcar_smooth(self.data[blk], width, padval)
+            _map_blocks(smooth_block, \
+                        _channel_blocks(self.numchans, self.numspectra))
                     
+    def processed(self, plan):
+        """Return a copy of the Spectra object with all the operations
+            of a ProcessingPlan applied. The result is the same as
+            calling the individual methods one after the other, but
+            the data are processed one subband at a time. The full
+            resolution data are read once (twice with zero-DM
+            filtering) and only the downsampled result is allocated.
+
+            Input:
+                plan: A ProcessingPlan object.
+
+            Output:
+                processed_spectra: A processed version of the
+                    Spectra object.
+
+            *** The original Spectra object is not modified ***
+        """
+        numspectra = self.numspectra
+        if plan.zerodm:
+            zerodm_ts = self.data.mean(axis=0)
+        else:
+            zerodm_ts = None
+
+        # Channel shifts within subbands
+        if (plan.nsub is not None) and (plan.subdm is not None):
+            assert (self.numchans % plan.nsub) == 0
+            assert plan.subdm >= 0
+            nsub = plan.nsub
+            freqs = _subband_freqs(self.freqs, nsub)
+            subbins = DelayTable.get(self.freqs, self.dt).bindelays( \
+                                            plan.subdm-self.dm, nsub)
+        else:
+            nsub = self.numchans
+            freqs = self.freqs
+            subbins = np.zeros(self.numchans, dtype='int')
+        nchan_per_sub = self.numchans//nsub
+
+        # Subband shifts for dedispersion
+        dm = self.dm
+        if plan.dm:
+            assert plan.dm >= 0
+            dedispbins = DelayTable.get(freqs, self.dt).bindelays(plan.dm-self.dm)
+            dm = plan.dm
+        else:
+            dedispbins = np.zeros(nsub, dtype='int')
+
+        # One output allocation; intermediate results live in a few
+        # row-sized scratch buffers (one set per block of subbands).
+        factor = plan.downsamp
+        if plan.dtype is None:
+            dtype = self.data.dtype
+        else:
+            dtype = plan.dtype
+        data = np.empty((nsub, numspectra//factor), dtype=dtype)
+        def process_block(blk):
+            chanbuf = np.empty(numspectra, dtype=dtype)
+            subbuf = np.empty(numspectra, dtype=dtype)
+            dedispbuf = np.empty(numspectra, dtype=dtype)
+            for isub in range(blk.start, blk.stop):
+                for ichan in range(isub*nchan_per_sub, (isub+1)*nchan_per_sub):
+                    _shift_row(self.data[ichan], subbins[ichan], \
+                                plan.padval, chanbuf, sub=zerodm_ts)
+                    if ichan == isub*nchan_per_sub:
+                        subbuf[:] = chanbuf
+                    else:
+                        subbuf += chanbuf
+                _shift_row(subbuf, dedispbins[isub], plan.padval, dedispbuf)
+                _downsample_sum(dedispbuf[np.newaxis], factor, \
+                                out=data[isub:isub+1])
+        _map_blocks(process_block, \
+                    _channel_blocks(nsub, numspectra*nchan_per_sub))
+
+        other = copy.copy(self)
+        other.data = data
+        other.freqs = freqs
+        other.numchans = nsub
+        other.numspectra = data.shape[1]
+        other.dt = self.dt*factor
+        other.dm = dm
+
+        # Scale
+        other.scaled(plan.scaleindep, inplace=True)
+
+        # Smooth
+        if plan.width_bins > 1:
+            other.smooth(plan.width_bins, padval=plan.padval)
+        return other
+
     def trim(self, bins=0):
         """Trim the end of the data by 'bins' spectra.
             
@@ -313,7 +770,7 @@ class Spectra(object):
             self.numspectra = self.numspectra-bins
             self.starttime = self.starttime+bins*self.dt
 
-    def downsample(self, factor=1, trim=True):
+    def downsample(self, factor=1, trim=True, out=None):
         """Downsample (in-place) the spectra by co-adding
             'factor' adjacent bins.
 
@@ -322,6 +779,9 @@ class Spectra(object):
                     factor. Must be a factor of the number of
                     spectra if 'trim' is False.
                 trim: Trim off excess bins.
+                out: Optional preallocated array of shape
+                    (numchans, numspectra/factor) to hold the
+                    downsampled data. (Default: allocate a new array)
 
             Ouputs:
                 None
@@ -332,7 +792,168 @@ class Spectra(object):
         new_num_spectra = self.numspectra/factor
         num_to_trim = self.numspectra%factor
         self.trim(num_to_trim)
-        self.data = np.array(np.column_stack([np.sum(subint, axis=1) for \
-                        subint in np.hsplit(self.data,new_num_spectra)]))
+        self.data = _downsample_sum(self.data, factor, out)
         self.numspectra = new_num_spectra
         self.dt = self.dt*factor
+
+
+# Spectra methods that modify the object in place
+_INPLACE_OPS = ('masked', 'subband', 'dedisperse', 'downsample', 'smooth')
+
+
+def _op_key(value):
+    """Return a hashable key for an argument of a recorded operation.
+        Arrays are identified by the object itself rather than their
+        contents.
+    """
+    if isinstance(value, np.ndarray):
+        return ('ndarray', id(value))
+    elif isinstance(value, (tuple, list)):
+        return tuple(_op_key(v) for v in value)
+    return value
+
+
+class LazySpectra(object):
+    """A Spectra object whose operations are recorded instead of run.
+        Each operation returns a new LazySpectra object, and the
+        operations are only run when the data (or any other
+        attribute of the underlying Spectra object) are accessed.
+
+        Recording the same operation twice on the same object returns
+        the same LazySpectra object (as long as it is still in use),
+        and each result is computed once, so operations shared by
+        several chains (e.g. reading and masking) are only run once.
+
+        A result is only kept while its LazySpectra object is
+        referenced (or has children that have not been run). An
+        in-place operation reuses its parent's data instead of
+        copying them only if the parent's result is owned by the
+        chain and the parent object can no longer be reached. A
+        result is owned if an operation created it (or 'consume'
+        was set for the starting Spectra object) and it has not
+        been handed out through 'data', materialize() or any other
+        attribute. Otherwise the data are copied, so anything the
+        caller holds is never modified.
+
+        *** Results are shared; do not modify them in place ***
+    """
+    def __init__(self, spectra, parent=None, op=None, consume=False):
+        """LazySpectra constructor.
+
+            Inputs:
+                spectra: The Spectra object to start from. (None when
+                    the object is the result of an operation.)
+                parent: The LazySpectra object the operation is
+                    applied to. (Default: None)
+                op: The operation, as a tuple of method name,
+                    arguments and keyword arguments. (Default: None)
+                consume: If True, 'spectra' may be modified by the
+                    first in-place operation instead of being copied.
+                    Only use this if the caller does not use
+                    'spectra' (or its data) again. (Default: False)
+
+            Output:
+                lazy_spectra: LazySpectra object.
+        """
+        self._result = spectra
+        self._parent = parent
+        self._op = op
+        # True while the result can only be reached through this
+        # object, so a child may modify it in place
+        self._owned = consume
+        # Children are only kept while they are in use elsewhere
+        self._children = weakref.WeakValueDictionary()
+
+    def _record(self, name, *args, **kwargs):
+        key = (name, _op_key(args), _op_key(sorted(kwargs.items())))
+        child = self._children.get(key)
+        if child is None:
+            child = LazySpectra(None, self, (name, args, kwargs))
+            self._children[key] = child
+        return child
+
+    def _materialize(self):
+        """Run the recorded operations (if they have not been run
+            already) without handing the result out.
+        """
+        if self._result is None:
+            parent = self._parent
+            source = parent._materialize()
+            owned = parent._owned
+            name, args, kwargs = self._op
+            # The parent is not needed any more. If nothing else
+            # refers to it, no other operation can use its result.
+            self._parent = None
+            parent_ref = weakref.ref(parent)
+            del parent
+            if name in _INPLACE_OPS:
+                if owned and (parent_ref() is None):
+                    result = source
+                else:
+                    # Keep the parent's result intact for other chains
+                    result = copy.copy(source)
+                    result.data = source.data.copy()
+                getattr(result, name)(*args, **kwargs)
+            else:
+                result = getattr(source, name)(*args, **kwargs)
+            self._result = result
+            self._owned = True
+        return self._result
+
+    def materialize(self):
+        """Run the recorded operations (if they have not been
+            run already) and return the resulting Spectra object.
+        """
+        result = self._materialize()
+        # The caller may keep the result, so it is never reused
+        self._owned = False
+        return result
+
+    @property
+    def data(self):
+        return self.materialize().data
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.materialize(), name)
+
+    def masked(self, mask, maskval='median-mid80'):
+        """Record Spectra.masked. Returns a new LazySpectra object.
+        """
+        return self._record('masked', mask, maskval=maskval)
+
+    def subband(self, nsub, subdm=None, padval=0):
+        """Record Spectra.subband. Returns a new LazySpectra object.
+        """
+        return self._record('subband', nsub, subdm=subdm, padval=padval)
+
+    def dedisperse(self, dm=0, padval=0):
+        """Record Spectra.dedisperse. Returns a new LazySpectra object.
+        """
+        return self._record('dedisperse', dm=dm, padval=padval)
+
+    def downsample(self, factor=1, trim=True):
+        """Record Spectra.downsample. Returns a new LazySpectra object.
+        """
+        return self._record('downsample', factor=factor, trim=trim)
+
+    def scaled(self, indep=False):
+        """Record Spectra.scaled. Returns a new LazySpectra object.
+        """
+        return self._record('scaled', indep)
+
+    def scaled2(self, indep=False):
+        """Record Spectra.scaled2. Returns a new LazySpectra object.
+        """
+        return self._record('scaled2', indep)
+
+    def smooth(self, width=1, padval=0):
+        """Record Spectra.smooth. Returns a new LazySpectra object.
+        """
+        return self._record('smooth', width=width, padval=padval)
+
+    def processed(self, plan):
+        """Record Spectra.processed. Returns a new LazySpectra object.
+        """
+        return self._record('processed', plan)
@@ -0,0 +1,63 @@
+"""
+Unpack data with fewer than 8 bits per sample.
+
+Each packed byte is decoded with a 256-entry lookup table, so unpacking
+is a single vectorized gather into the output array.
+
+PSRFITS stores the first sample of each byte in its most significant
+bits. SIGPROC filterbank files store it in the least significant bits.
+"""
+import numpy as np
+
+
+def _make_table(nbits, msb_first):
+    """Return a (256, 8/nbits) table of the samples packed into
+        each possible byte value.
+    """
+    nper = 8//nbits
+    shifts = np.arange(nper)*nbits
+    if msb_first:
+        shifts = shifts[::-1]
+    values = np.arange(256, dtype='uint8')[:,np.newaxis]
+    return ((values >> shifts) & (2**nbits-1)).astype('uint8')
+
+
+# Lookup tables keyed by (nbits, msb_first)
+_tables = {}
+for _nbits in (1, 2, 4):
+    for _msb_first in (True, False):
+        _tables[(_nbits, _msb_first)] = _make_table(_nbits, _msb_first)
+
+
+def unpack(data, nbits, out=None, msb_first=True):
+    """Unpack 'nbits'-bit samples that have been read in as bytes.
+        The last axis of 'data' is unpacked.
+
+        Inputs:
+            data: array of bytes (uint8).
+            nbits: Number of bits per sample (1, 2, 4 or 8).
+                8-bit data are returned as they are.
+            out: Optional preallocated, contiguous uint8 array
+                with 8/nbits times as many elements as 'data'.
+                (Default: allocate a new array)
+            msb_first: If True, the first sample is in the most
+                significant bits of each byte (PSRFITS). Use
+                False for SIGPROC filterbank data. (Default: True)
+
+        Output:
+            outdata: unpacked array. The last axis is 8/nbits
+                times longer than that of 'data'.
+    """
+    data = np.asarray(data, dtype='uint8')
+    if nbits == 8:
+        return data
+    if (nbits, bool(msb_first)) not in _tables:
+        raise ValueError("Cannot unpack %d-bit data! (Only 1-, 2-, 4- " \
+                            "and 8-bit data are supported.)" % nbits)
+    table = _tables[(nbits, bool(msb_first))]
+    nper = 8//nbits
+    shape = data.shape[:-1] + (data.shape[-1]*nper,)
+    if out is None:
+        out = np.empty(shape, dtype='uint8')
+    np.take(table, data, axis=0, out=out.reshape(data.shape+(nper,)))
+    return out.reshape(shape)
@@ -14,13 +14,8 @@ import sys
 import optparse
 import copy
 
-import matplotlib.pyplot as plt
-import matplotlib.cm
 import numpy as np
 
-import psr_utils
-import rfifind
-
 from sp_pulsar.formats import spectra
 
 SWEEP_STYLES = ['r-', 'b-', 'g-', 'm-', 'c-']
@@ -50,6 +45,7 @@ def get_mask(rfimask, startsamp, N):
         
 def maskfile(data, start_bin, nbinsextra):
     if options.maskfile is not None:
+        import rfifind
         rfimask = rfifind.rfifind(options.maskfile) 
         mask = get_mask(rfimask, start_bin, nbinsextra)
         # Mask data
@@ -57,47 +53,39 @@ def maskfile(data, start_bin, nbinsextra):
 
         datacopy = copy.deepcopy(data)
     return data
-def waterfall(start_bin, dmfac, duration, nbins, zerodm, nsub, subdm, dm, integrate_dm, downsamp, scaleindep, width_bins, rawdatafile, binratio, data):
+def waterfall(start_bin, dmfac, duration, nbins, zerodm, nsub, subdm, dm, integrate_dm, downsamp, scaleindep, width_bins, rawdatafile, binratio, data, dtype=None):
     if dm:
         nbinsextra = np.round((duration + dmfac * dm)/rawdatafile.tsamp).astype('int')
     else:
         nbinsextra = nbins
 
-    # Zerodm filtering
-    if (zerodm == True):
-        data.data -=  data.data.mean(axis=0)
-    
-    # Subband data
-    if (nsub is not None) and (subdm is not None):
-        data.subband(nsub, subdm, padval='mean')
-
-    # Dedisperse
-    if dm:
-        data.dedisperse(dm, padval='mean')
-
-    # Downsample
-    data.downsample(downsamp)
-
-    # scale data
-    data = data.scaled(scaleindep)
-    
-    # Smooth
-    if width_bins > 1:
-        data.smooth(width_bins, padval='mean')
+    # Zero-DM filter, subband, dedisperse, downsample, scale and
+    # smooth the data in a single pass
+    plan = spectra.ProcessingPlan(zerodm=(zerodm == True), nsub=nsub, \
+                                  subdm=subdm, dm=dm, downsamp=downsamp, \
+                                  scaleindep=scaleindep, width_bins=width_bins, \
+                                  padval='mean', dtype=dtype)
+    data = data.processed(plan)
 
     return data, nbinsextra
 def main():
+    # Plotting and PRESTO modules are only needed when run as a script
+    import matplotlib.pyplot as plt
+    import matplotlib.cm
+    import psr_utils
+
     fn = args[0]
     if fn.endswith(".fil"):
         # Filterbank file
         filetype = "filterbank"
-        from pypulsar.formats import filterbank
-        rawdatafile = filterbank.filterbank(fn)
+        from sp_pulsar.formats import filterbank
+        rawdatafile = filterbank.FilterbankFile(fn)
     elif fn.endswith(".fits"):
         # PSRFITS file
         filetype = "psrfits"
         from sp_pulsar.formats import psrfits
-        rawdatafile = psrfits.PsrfitsFile(fn)
+        # Several files are read as one continuous observation
+        rawdatafile = psrfits.PsrfitsFile(args, header_cache=True)
     else:
         raise ValueError("Cannot recognize data file type from "
                          "extension. (Only '.fits' and '.fil' "
@@ -105,7 +93,7 @@ def main():
 
     # Read data
     start_bin = np.round(options.start/rawdatafile.tsamp).astype('int')
-    dmfac = 4.15e3 * np.abs(1./rawdatafile.frequencies[0]**2 - 1./rawdatafile.frequencies[-1]**2)
+    dmfac = spectra.DelayTable.get(rawdatafile.frequencies, rawdatafile.tsamp).dmfac
     if options.nbins is None:
         nbins = np.round(options.duration/rawdatafile.tsamp).astype('int')
     else:
@@ -115,7 +103,7 @@ def main():
 	nbinsextra = np.round((options.duration + dmfac * options.dm)/rawdatafile.tsamp).astype('int')
     else:
         nbinsextra = nbins    
-    data = rawdatafile.get_spectra(start_bin, nbinsextra)
+    data = rawdatafile.get_spectra(start_bin, nbinsextra, dtype=options.dtype)
     data = maskfile(data, start_bin, nbinsextra)
     data, bins = waterfall(start_bin, dmfac, options.duration, nbins, options.zerodm, options.nsub, options.subdm, options.dm, options.integrate_dm, options.downsamp, options.scaleindep, options.width_bins, rawdatafile, binratio, data)
     # Ploting it up
@@ -174,7 +162,7 @@ def main():
 if __name__=='__main__':
     parser = optparse.OptionParser(prog="waterfaller.py", \
                         version="v0.9 Patrick Lazarus (Aug. 19, 2011)", \
-                        usage="%prog [OPTIONS] INFILE", \
+                        usage="%prog [OPTIONS] INFILE [INFILE ...]", \
                         description="Create a waterfall plot to show the " \
                                     "frequency sweep of a single pulse " \
                                     "in psrFits data.")
@@ -238,6 +226,15 @@ if __name__=='__main__':
                         help="The name of a valid matplotlib colour map." \
                                 "(Default: gist_yarg.)", \
                         default='gist_yarg')
+    parser.add_option('--threads', dest='threads', type='int', \
+                        help="Number of threads to process the data " \
+                                "with. (Default: $SP_NUM_THREADS, or 1)", \
+                        default=None)
+    parser.add_option('--dtype', dest='dtype', type='choice', \
+                        choices=['float32', 'float64'], \
+                        help="Floating point type to process the data " \
+                                "with. (Default: float32)", \
+                        default='float32')
     options, args = parser.parse_args()
     
     if not hasattr(options, 'start'):
@@ -249,4 +246,6 @@ if __name__=='__main__':
                             "must be given on command line!")
     if options.subdm is None:
         options.subdm = options.dm
+    if options.threads is not None:
+        spectra.set_num_threads(options.threads)
     main()